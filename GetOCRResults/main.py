@@ -1,11 +1,21 @@
 import boto3
+import heapq
 import json
+import random
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 """
 Get OCR job results for key-value pairs and raw text from DynamoDB job Ids to store in folder structure
 in S3 bucket. In S3, each transcript document gets a folder named after it. In each folder are two JSON
 files. One for key_value pair OCR results and one for raw_text OCR results.
 """
+PART_SIZE = 8 * 1024 * 1024  # S3 multipart parts must be at least 5 MB, except for the last one
+
+# Error codes AWS uses when a request is throttled rather than rejected
+THROTTLING = {'ThrottlingException', 'ProvisionedThroughputExceededException', 'LimitExceededException',
+              'RequestLimitExceeded', 'TooManyRequestsException', 'SlowDown'}
+
 # Establish AWS client connections
 textract = boto3.client('textract', region_name='us-east-2')
 db = boto3.resource('dynamodb', region_name='us-east-2')
@@ -14,27 +24,226 @@ s3 = boto3.client('s3', region_name='us-east-2')
 # Connect to DynamoDB table
 table = db.Table('TestTable251')
 
-# Get job ids and ARN from database
-scan = table.scan()
-for transcript in scan['Items']:
+"""
+Gets every page of results of a Textract job. Long transcripts do not fit in one response,
+so the NextToken of each page is followed until Textract stops returning one
+
+Parameters
+----------
+fetch: (function) textract.get_document_analysis or textract.get_document_text_detection
+
+job_id: (string) the id of the Textract job
+
+Returns
+-------
+pages: (generator) each Textract response in turn, so only one page is held at a time
+"""
+def getResultPages(fetch, job_id):
+    kwargs = {'JobId': job_id, 'MaxResults': 1000}
+    while True:
+        page = fetch(**kwargs)
+        yield page
+        if not page.get('NextToken'):
+            break
+        kwargs['NextToken'] = page['NextToken']
+
+"""
+Writes the pages of a Textract job to S3 as a single JSON object with a multipart upload. The
+object has the fields of the first page (DocumentMetadata, JobStatus, ...) and one 'Blocks'
+array with the blocks of every page, so downstream extraction reads it like a single response.
+Memory stays bounded by one page plus one upload part
+
+Parameters
+----------
+pages: (iterable) the Textract responses of one job, e.g. from getResultPages(...)
+
+bucket: (string) the string name of the S3 bucket the results are stored in
+
+key: (string) the S3 key of the JSON file (e.g., '<transcript>/kv.json')
+"""
+def uploadResults(pages, bucket, key):
+    upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key, ContentType='application/json')['UploadId']
+    parts = []
+    buffer = bytearray()
+
+    def flush():
+        number = len(parts) + 1
+        etag = s3.upload_part(Bucket=bucket, Key=key, UploadId=upload_id,
+                              PartNumber=number, Body=bytes(buffer))['ETag']
+        parts.append({'ETag': etag, 'PartNumber': number})
+        buffer.clear()
+
+    try:
+        first_block = True
+        for i, page in enumerate(pages):
+            if i == 0:
+                fields = {k: v for k, v in page.items() if k not in ('Blocks', 'NextToken', 'ResponseMetadata')}
+                header = json.dumps(fields)[:-1]  # Leave the object open for the blocks
+                buffer += (header + (', ' if len(fields) > 0 else '') + '"Blocks": [').encode('utf-8')
+            for block in page.get('Blocks', []):
+                buffer += ((', ' if not first_block else '') + json.dumps(block)).encode('utf-8')
+                first_block = False
+                if len(buffer) >= PART_SIZE:
+                    flush()
+        buffer += b']}'
+        flush()
+
+        s3.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+                                     MultipartUpload={'Parts': parts})
+    except BaseException:
+        s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+
+"""
+Gets the results of the OCR jobs of one transcript and stores them in S3
+
+Parameters
+----------
+transcript: (dictionary) an item of the job table with the 'ARN', 'kv_job' and 'raw_job' of a
+                         transcript
+"""
+def storeResults(transcript):
     arn = transcript['ARN']
     kv_job = transcript['kv_job']
     raw_job = transcript['raw_job']
-    
-    # Get OCR results for key-value pairs and raw text
-    kv_results = str(json.dumps(textract.get_document_analysis(JobId=kv_job)))
-    raw_results = str(json.dumps(textract.get_document_text_detection(JobId=raw_job)))
-    
+
     # Store key-value pair OCR results in kv.json file
-    s3.put_object(
-        Body=kv_results,
-        Bucket='results251',
-        Key=f'{arn[28:]}/kv.json'
-    )
-    
+    uploadResults(getResultPages(textract.get_document_analysis, kv_job), 'results251', f'{arn[28:]}/kv.json')
+
     # Store raw text OCR results in raw.json file
-    s3.put_object(
-        Body=raw_results,
-        Bucket='results251',
-        Key=f'{arn[28:]}/raw.json'
+    uploadResults(getResultPages(textract.get_document_text_detection, raw_job), 'results251', f'{arn[28:]}/raw.json')
+
+"""
+Gets every transcript in the job table whose results have not been collected yet. The table
+is scanned page by page, so tables larger than the 1 MB scan limit are covered
+
+Returns
+-------
+transcripts: (generator) each item of the job table without a 'JobState' of 'STORED' or 'FAILED'
+"""
+def scanJobs():
+    kwargs = {}
+    while True:
+        scan = table.scan(**kwargs)
+        for transcript in scan['Items']:
+            if transcript.get('JobState') not in ('STORED', 'FAILED'):
+                yield transcript
+        if 'LastEvaluatedKey' not in scan:
+            break
+        kwargs['ExclusiveStartKey'] = scan['LastEvaluatedKey']
+
+"""
+Checks both OCR jobs of a transcript and stores their results once both have finished
+
+Parameters
+----------
+transcript: (dictionary) an item of the job table with the 'ARN', 'kv_job' and 'raw_job' of a
+                         transcript
+
+Returns
+-------
+state: (string) 'STORED' if the results were stored, 'FAILED' if either job failed and
+                'IN_PROGRESS' if a job is still running (or the status check was throttled)
+"""
+def checkTranscript(transcript):
+    statuses = []
+    for fetch, job in ((textract.get_document_analysis, transcript['kv_job']),
+                       (textract.get_document_text_detection, transcript['raw_job'])):
+        try:
+            statuses.append(fetch(JobId=job, MaxResults=1)['JobStatus'])
+        except Exception as e:
+            if getattr(e, 'response', {}).get('Error', {}).get('Code') in THROTTLING:
+                return 'IN_PROGRESS'
+            raise
+
+    if 'FAILED' in statuses:
+        return 'FAILED'
+    if all(status in ('SUCCEEDED', 'PARTIAL_SUCCESS') for status in statuses):
+        storeResults(transcript)
+        return 'STORED'
+    return 'IN_PROGRESS'
+
+"""
+Records in the job table that a transcript's results were stored or that its jobs failed, so
+later runs skip it
+
+Parameters
+----------
+transcript: (dictionary) an item of the job table
+
+state: (string) 'STORED' or 'FAILED'
+"""
+def markJob(transcript, state):
+    table.update_item(
+        Key={'ARN': transcript['ARN']},
+        UpdateExpression='SET JobState = :state',
+        ExpressionAttributeValues={':state': state}
     )
+
+"""
+Collects the results of every job in the table as the jobs finish. Transcripts are checked
+concurrently on a thread pool. Each one that is still running is checked again after a
+delay that doubles on every attempt, up to max_poll seconds. Results are fetched and stored
+only once both jobs have SUCCEEDED, and transcripts with a FAILED job are marked as such
+
+Parameters
+----------
+workers: (int) the number of transcripts checked (or stored) at the same time
+
+poll: (float) seconds before the first re-check of a running transcript
+
+max_poll: (float) the longest wait between checks of a transcript. Bounds how long after the
+                  last job finishes the collection ends
+
+max_errors: (int) unexpected errors tolerated per transcript before it is given up on
+
+Returns
+-------
+summary: (dictionary) the number of transcripts 'STORED' and 'FAILED', and the ARNs that hit
+                      too many 'Errors'
+"""
+def collectResults(workers=16, poll=5.0, max_poll=60.0, max_errors=5):
+    summary = {'STORED': 0, 'FAILED': 0, 'Errors': []}
+    queue = []  # (due time, order, transcript, attempt, errors)
+    for order, transcript in enumerate(scanJobs()):
+        queue.append((0.0, order, transcript, 0, 0))
+    heapq.heapify(queue)
+
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while queue or running:
+            now = time.monotonic()
+            while queue and queue[0][0] <= now and len(running) < workers:
+                due, order, transcript, attempt, errors = heapq.heappop(queue)
+                running[pool.submit(checkTranscript, transcript)] = (order, transcript, attempt, errors)
+
+            timeout = max(0.0, queue[0][0] - now) if queue else None
+            if not running:
+                time.sleep(timeout)
+                continue
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                order, transcript, attempt, errors = running.pop(future)
+                try:
+                    state = future.result()
+                except Exception as e:
+                    print(f'Error collecting {transcript["ARN"]}: {e}')
+                    errors += 1
+                    if errors >= max_errors:
+                        summary['Errors'].append(transcript['ARN'])
+                        continue
+                    state = 'IN_PROGRESS'
+
+                if state in ('STORED', 'FAILED'):
+                    markJob(transcript, state)
+                    summary[state] += 1
+                    print(f'{transcript["ARN"]}: {state}')
+                else:
+                    delay = random.uniform(0.5, 1.0) * min(max_poll, poll * 2 ** attempt)
+                    heapq.heappush(queue, (time.monotonic() + delay, order, transcript, attempt + 1, errors))
+
+    return summary
+
+if __name__ == '__main__':
+    print(collectResults())
@@ -0,0 +1,161 @@
+import numpy as np
+from collections import deque
+
+"""
+Counts the aliases and antialiases of every metadata type in a piece of text with a single pass.
+Every alias and antialias in meta.data is compiled into one Aho-Corasick automaton per side
+('key' and 'value'), so the cost of scanning a key or value no longer grows with the number
+of aliases we add. Built once when meta.data is loaded (see loadData in main.py).
+
+The 'raw' side holds the aliases Phase 2 reads the labels of raw text lines with (see
+RawEntDetector). They come from the "raw" section of meta.data, or the key aliases if there is
+none, and only match at the start of a word, so 'to' is not found in 'history'.
+
+Parameters
+----------
+META: (dictionary) a mapping of different of key words (aliases) and words that indicate wrong
+                   selection (antialiases) to our desired metadata, as loaded from meta.data
+"""
+class AliasMatcher():
+
+    def __init__(self, META):
+        self.types = list(META['key'].keys())
+        self.automata = {}
+        for side in ('key', 'value', 'raw'):
+            patterns = {}
+            for name, aliases in META.get(side, META['key']).items():
+                for kind in ('alias', 'antialias'):
+                    for alias in aliases[kind]:
+                        patterns.setdefault(alias.lower(), []).append((name, kind))
+            self.automata[side] = self.__compile__(patterns, bounded=side == 'raw')
+
+    """
+    Counts how many aliases and antialiases of each metadata type appear in a piece of text.
+    Like a substring search per alias, an alias counts once no matter how many times it
+    appears, and overlapping aliases (e.g., 'grad' and 'graduation') all count
+
+    Parameters
+    ----------
+    text: (string) the lower-cased text of a key or value
+
+    side: (string) 'key', 'value' or 'raw', which set of aliases from meta.data to use
+
+    Returns
+    -------
+    hits: (dictionary) key is a metadata type (e.g., 'Name') and is mapped to another dictionary
+                       with the number of 'alias' and 'antialias' hits found in the text
+    """
+    def count(self, text, side):
+        outputs, always = self.automata[side][3:5]
+
+        hits = {name: {'alias': 0, 'antialias': 0} for name in self.types}
+        for pattern in self.__scan__(text, side):
+            for name, kind in outputs[pattern]:
+                hits[name][kind] += 1
+        for name, kind in always:
+            hits[name][kind] += 1
+        return hits
+
+    """
+    Counts the aliases and antialiases of each metadata type in many pieces of text at once, as
+    the rows of one matrix (see count(...))
+
+    Parameters
+    ----------
+    texts: (list) the lower-cased text of keys or values
+
+    side: (string) 'key' or 'value', which set of aliases from meta.data to use
+
+    Returns
+    -------
+    hits: (array) of shape (len(texts), 2, len(types)), where hits[row, 0] counts the aliases
+                  and hits[row, 1] the antialiases of every metadata type in self.types order
+    """
+    def matrix(self, texts, side):
+        outputs, always = self.automata[side][3:5]
+        column = {name: i for i, name in enumerate(self.types)}
+        kind_row = {'alias': 0, 'antialias': 1}
+
+        hits = np.zeros((len(texts), 2, len(self.types)), dtype=np.int64)
+        for row, text in enumerate(texts):
+            for pattern in self.__scan__(text, side):
+                for name, kind in outputs[pattern]:
+                    hits[row, kind_row[kind], column[name]] += 1
+        for name, kind in always:
+            hits[:, kind_row[kind], column[name]] += 1
+        return hits
+
+    """
+    Runs a piece of text through the automaton of one side
+
+    Returns
+    -------
+    found: (set) the indices of every pattern found in the text
+    """
+    def __scan__(self, text, side):
+        goto, fail, output, outputs, always, lengths = self.automata[side]
+
+        found = set()
+        state = 0
+        for end, char in enumerate(text, 1):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                if lengths is None:
+                    found.update(output[state])
+                else:  # Only patterns that start a word
+                    found.update(pattern for pattern in output[state]
+                                 if end == lengths[pattern] or not text[end - lengths[pattern] - 1].isalnum())
+        return found
+
+    """
+    Builds the automaton for a set of patterns
+
+    Parameters
+    ----------
+    patterns: (dictionary) key is an alias and is mapped to a list of the (type, kind) entries
+                           in meta.data that use it
+
+    bounded: (boolean) if True, patterns are only found at the start of a word
+
+    Returns
+    -------
+    automaton: (tuple) goto transitions, failure links, the patterns ending at each state, the
+                       (type, kind) entries of each pattern, the entries of empty aliases, which
+                       are found in any text, and the length of each pattern if bounded (else None)
+    """
+    def __compile__(self, patterns, bounded=False):
+        goto = [{}]
+        output = [set()]
+        outputs = []
+        always = []
+        for pattern, entries in patterns.items():
+            if pattern == '':
+                always.extend(entries)
+                continue
+            state = 0
+            for char in pattern:
+                if char not in goto[state]:
+                    goto.append({})
+                    output.append(set())
+                    goto[state][char] = len(goto) - 1
+                state = goto[state][char]
+            output[state].add(len(outputs))
+            outputs.append(entries)
+
+        # Breadth first so that every failure link points to an already finished state
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in goto[state].items():
+                queue.append(child)
+                link = fail[state]
+                while link and char not in goto[link]:
+                    link = fail[link]
+                fail[child] = goto[link].get(char, 0)
+                output[child] |= output[fail[child]]
+
+        lengths = [len(pattern) for pattern in patterns if pattern != ''] if bounded else None
+        return goto, fail, output, outputs, always, lengths
@@ -0,0 +1,207 @@
+import json
+import mmap
+import struct
+import sys
+from array import array
+
+"""
+A compact binary artifact holding everything extraction reads from a transcript's Textract
+output, already resolved: the key text, value text and Top of every key-value pair, the
+text, Top, Left and Page of every line, and the confidence of both OCR jobs. Converting the
+corpus once (see convertArtifacts in main.py) lets re-extraction runs after a meta.data or
+scoring change skip the Textract JSON entirely.
+
+Layout (native byte order, recorded in the header):
+    b'TXA1' | uint32 header length | JSON header, padded to 8 bytes | sections
+The header holds the confidences, the counts and the byte offset of every section:
+    pair_top (float64), line_top (float64), line_left (float64), line_page (uint16),
+    string offsets (uint32) and the UTF-8 string blob with key, value and line texts
+Files are memory mapped, so strings are only decoded when a stage asks for them.
+"""
+MAGIC = b'TXA1'
+
+"""
+Writes the artifact of one transcript
+
+Parameters
+----------
+path: (string) file destination of the artifact
+
+mappings: (dictionary) the key-value pairs of the transcript, as returned by getMapping(...)
+
+kv_confidence: (float) the average confidence of the key-value pair OCR extraction
+
+lines: (list) the (text, top, left, page) tuples of every line, as returned by getLines(...)
+
+raw_confidence: (float) the average confidence of the raw text OCR extraction
+"""
+def writeArtifact(path, mappings, kv_confidence, lines, raw_confidence):
+    strings = []
+    pair_top = array('d')
+    for key, pair in mappings.items():
+        strings.append(key)
+        strings.append(pair['Value'])
+        pair_top.append(pair['Top'])
+
+    line_top = array('d')
+    line_left = array('d')
+    line_page = array('H')
+    for text, top, left, page in lines:
+        strings.append(text)
+        line_top.append(top)
+        line_left.append(left)
+        line_page.append(page)
+
+    blob = bytearray()
+    string_offsets = array('I', [0])
+    for text in strings:
+        blob += text.encode('utf-8')
+        string_offsets.append(len(blob))
+
+    sections = [('pair_top', pair_top.tobytes()), ('line_top', line_top.tobytes()),
+                ('line_left', line_left.tobytes()), ('line_page', line_page.tobytes()),
+                ('strings', string_offsets.tobytes()), ('blob', bytes(blob))]
+
+    header = {'kv_confidence': kv_confidence, 'raw_confidence': raw_confidence,
+              'pairs': len(pair_top), 'lines': len(line_top), 'byteorder': sys.byteorder}
+    # The header size depends on the offsets it holds, so they are measured from its end
+    offsets = {}
+    position = 0
+    for name, data in sections:
+        offsets[name] = position
+        position += __pad__(len(data))
+    header['offsets'] = offsets
+
+    encoded = json.dumps(header).encode('utf-8')
+    start = __pad__(len(MAGIC) + 4 + len(encoded))
+    with open(path, 'wb') as fp:
+        fp.write(MAGIC)
+        fp.write(struct.pack('=I', len(encoded)))
+        fp.write(encoded)
+        fp.write(b'\0' * (start - len(MAGIC) - 4 - len(encoded)))
+        for name, data in sections:
+            fp.write(data)
+            fp.write(b'\0' * (__pad__(len(data)) - len(data)))
+
+"""
+Opens the artifact of one transcript
+
+Parameters
+----------
+path: (string) file destination of the artifact
+
+Returns
+-------
+kv_json: (dictionary) stand-in for the key-value pair Textract output whose 'Blocks' are the
+                      already resolved Pairs of the artifact
+raw_json: (dictionary) stand-in for the raw text Textract output whose 'Blocks' are the
+                       already resolved Lines of the artifact
+"""
+def loadArtifact(path):
+    artifact = Artifact(path)
+    return {'Blocks': artifact.pairs, 'Artifact': artifact}, {'Blocks': artifact.lines, 'Artifact': artifact}
+
+"""
+A memory mapped artifact file
+
+Parameters
+----------
+path: (string) file destination of the artifact
+"""
+class Artifact():
+
+    def __init__(self, path):
+        with open(path, 'rb') as fp:
+            self.map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.map)
+        if bytes(view[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f'{path} is not a transcript artifact')
+        length = struct.unpack_from('=I', self.map, len(MAGIC))[0]
+        header = json.loads(bytes(view[len(MAGIC) + 4:len(MAGIC) + 4 + length]))
+        if header['byteorder'] != sys.byteorder:
+            raise ValueError(f'{path} was written on a {header["byteorder"]}-endian machine')
+
+        start = __pad__(len(MAGIC) + 4 + length)
+        offsets = header['offsets']
+        n = header['pairs']
+        m = header['lines']
+
+        def section(name, code, count):
+            begin = start + offsets[name]
+            return view[begin:begin + count * struct.calcsize(code)].cast(code)
+
+        self.view = view
+        self.strings = section('strings', 'I', 2 * n + m + 1)
+        self.blob = view[start + offsets['blob']:start + offsets['blob'] + self.strings[-1]]
+        self.pairs = Pairs(self, section('pair_top', 'd', n), header['kv_confidence'])
+        self.lines = Lines(self, section('line_top', 'd', m), section('line_left', 'd', m),
+                           section('line_page', 'H', m), header['raw_confidence'])
+
+    """
+    Unmaps the file. Pairs and Lines of the artifact can no longer be read afterwards
+    """
+    def close(self):
+        for view in (self.pairs.top, self.lines.top, self.lines.left, self.lines.page,
+                     self.strings, self.blob, self.view):
+            view.release()
+        self.map.close()
+
+    """
+    Decodes the i-th string of the artifact
+    """
+    def string(self, i):
+        return bytes(self.blob[self.strings[i]:self.strings[i + 1]]).decode('utf-8')
+
+"""
+The key-value pairs of an artifact, in place of the key-value pair blocks
+"""
+class Pairs():
+
+    def __init__(self, artifact, top, confidence):
+        self.artifact = artifact
+        self.top = top
+        self.confidence = confidence
+
+    """
+    Returns
+    -------
+    mappings: (dictionary) the key-value pairs in the same form getMapping(...) returns them
+    """
+    def mappings(self):
+        mappings = {}
+        for i in range(len(self.top)):
+            mappings[self.artifact.string(2 * i)] = {'Value': self.artifact.string(2 * i + 1),
+                                                     'Top': self.top[i]}
+        return mappings
+
+"""
+The lines of text of an artifact, in place of the raw text blocks
+"""
+class Lines():
+
+    def __init__(self, artifact, top, left, page, confidence):
+        self.artifact = artifact
+        self.top = top
+        self.left = left
+        self.page = page
+        self.confidence = confidence
+
+    """
+    Returns
+    -------
+    lines: (list) the (text, top, left, page) tuples in the same form getLines(...) returns them
+    """
+    def lines(self):
+        return [(self.text(i), self.top[i], self.left[i], self.page[i]) for i in range(len(self.top))]
+
+    """
+    Decodes the text of the i-th line
+    """
+    def text(self, i):
+        return self.artifact.string(2 * len(self.artifact.pairs.top) + i)
+
+"""
+Rounds a size up to the next multiple of 8 so that every section stays aligned
+"""
+def __pad__(size):
+    return (size + 7) // 8 * 8
@@ -0,0 +1,456 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import re
+import sys
+import time
+import tracemalloc
+import NERModel
+import DateNormalizer
+import main as pipeline
+from EntityDetector import EntityDetector, getFields
+from NERCache import NERCache
+from NameGazetteer import NameGazetteer
+from RawEntDetector import RawEntDetector
+from TextractStream import loadResponse
+from dateutil import parser
+
+"""
+Benchmarks the extraction stages on synthetic Textract output, so that throughput regressions
+show up before a bulk run instead of after it. generateDocument(...) builds kv.json and
+raw.json payloads with the same block types, relationships and geometry Textract returns,
+with a configurable number of pages, key-value pairs, lines and words per key, value and line.
+Each stage is timed on its own, per document, and the whole pipeline (main) is timed end to
+end. Results are the documents per second, latency percentiles per stage and the peak memory
+of a traced pass. They can be saved as a baseline and compared against later runs.
+
+    python Benchmark.py --docs 100 --ner stub --save baseline.json
+    python Benchmark.py --docs 100 --ner stub --baseline baseline.json
+
+NER is either stubbed (a rule-based model with no inference cost, which isolates the
+pipeline's own overhead) or the real spacy model (see NERModel.py).
+"""
+FIRST_NAMES = ['James', 'Mary', 'Robert', 'Patricia', 'John', 'Jennifer', 'Michael', 'Linda', 'David',
+               'Elizabeth', 'William', 'Barbara', 'Richard', 'Susan', 'Joseph', 'Jessica']
+LAST_NAMES = ['Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis', 'Wilson',
+              'Anderson', 'Taylor', 'Thomas', 'Moore', 'Jackson', 'Martin', 'Lee']
+MONTHS = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September',
+          'October', 'November', 'December']
+WORDS = ['Algebra', 'English', 'Biology', 'History', 'Chemistry', 'Physics', 'Spanish', 'Art', 'Music',
+         'Health', 'Geometry', 'Literature', 'Credits', 'Grade', 'Semester', 'Honors', 'Total', 'Units']
+DISTRACTORS = ['Parent Name', 'Guardian Name', 'School Name', 'Birth Date', 'Date Issued', 'Start Date',
+               'Address', 'Counselor', 'Registrar Signature', 'Student ID', 'Date of Entry']
+STAGES = ['parse', 'extractIds', 'getText', 'getMapping', 'getRawText', 'getRegionLines',
+          'detectEntityKV', 'detectEntity', 'document']
+
+"""
+Builds the kv.json and raw.json Textract output of one synthetic transcript. Every document has
+a student name and a graduation date among its key-value pairs (unless left out to force
+Phase 2) and near the top of its first page, surrounded by distractor fields and course rows
+
+Parameters
+----------
+pages: (int) the number of pages
+
+pairs: (int) the number of key-value pairs, spread over the pages
+
+lines: (int) the number of lines of text, spread over the pages
+
+fanout: (int) the number of words in each key, value and line (the CHILD relationships per block)
+
+seed: (int) seeds the random choices, so the same arguments always give the same document
+
+complete: (boolean) if False, the name and graduation date key-value pairs are left out
+
+Returns
+-------
+kv_json: (dictionary) output in the form of get_document_analysis(...) with FORMS
+
+raw_json: (dictionary) output in the form of get_document_text_detection(...)
+"""
+def generateDocument(pages=2, pairs=40, lines=80, fanout=3, seed=0, complete=True):
+    rng = random.Random(seed)
+    first = rng.choice(FIRST_NAMES)
+    last = rng.choice(LAST_NAMES)
+    year = rng.randint(1990, 2022)
+    grad = rng.choice([f'{rng.randint(1, 12):02d}/{rng.randint(1, 28):02d}/{year}',
+                       f'{rng.choice(MONTHS)} {year}', str(year)])
+    name = rng.choice([f'{last}, {first}', f'{first} {last}', f'{first} {rng.choice(FIRST_NAMES)[0]}. {last}'])
+
+    def words(count):
+        return ' '.join(rng.choice(WORDS) for _ in range(count))
+
+    # Key-value pairs: (page, key, value or None for a check box, top)
+    fields = []
+    if complete:
+        fields.append((1, 'Student Name', name, 0.08))
+        fields.append((1, 'Graduation Date', grad, 0.22))
+    while len(fields) < pairs:
+        page = rng.randint(1, pages)
+        if rng.random() < 0.3:
+            fields.append((page, rng.choice(DISTRACTORS), words(fanout), rng.random()))
+        elif rng.random() < 0.2:
+            fields.append((page, words(fanout), None, rng.random()))
+        else:
+            fields.append((page, words(fanout), words(fanout), rng.random()))
+
+    # Lines: (page, text, top)
+    text = [(1, 'Commonwealth of Pennsylvania', 0.02), (1, name, 0.08), (1, f'Graduated {grad}', 0.24)]
+    while len(text) < lines:
+        text.append((rng.randint(1, pages), words(fanout), rng.random()))
+
+    kv_blocks = __Blocks__(rng, pages)
+    for page, key, value, top in fields:
+        kv_blocks.pair(page, key, value, top)
+    raw_blocks = __Blocks__(rng, pages)
+    for page, line, top in text:
+        kv_blocks.line(page, line, top)
+        raw_blocks.line(page, line, top)
+
+    metadata = {'DocumentMetadata': {'Pages': pages}, 'JobStatus': 'SUCCEEDED'}
+    kv_json = dict(metadata, Blocks=kv_blocks.finish(), AnalyzeDocumentModelVersion='1.0')
+    raw_json = dict(metadata, Blocks=raw_blocks.finish(), DetectDocumentTextModelVersion='1.0')
+    return kv_json, raw_json
+
+"""
+Collects the blocks of one synthetic Textract response
+"""
+class __Blocks__():
+
+    def __init__(self, rng, pages):
+        self.rng = rng
+        self.blocks = []
+        self.count = 0
+        self.pages = [self.__block__('PAGE', p, 0.0, 0.0, 1.0, relationships=[]) for p in range(1, pages + 1)]
+
+    """
+    Adds a LINE block and its WORD blocks
+    """
+    def line(self, page, text, top):
+        left = self.rng.uniform(0.05, 0.5)
+        line = self.__block__('LINE', page, top, left, 0.4, Text=text, Relationships=[
+            {'Type': 'CHILD', 'Ids': self.__words__(page, text, top, left)}])
+        self.pages[page - 1]['Relationships'][0]['Ids'].append(line['Id'])
+
+    """
+    Adds a KEY block, its VALUE block and their WORD (or SELECTION_ELEMENT) blocks
+    """
+    def pair(self, page, key, value, top):
+        if value is None:
+            status = self.rng.choice(['SELECTED', 'NOT_SELECTED'])
+            children = [self.__block__('SELECTION_ELEMENT', page, top, 0.6, 0.02, SelectionStatus=status)['Id']]
+        else:
+            children = self.__words__(page, value, top, 0.5)
+        value = self.__block__('KEY_VALUE_SET', page, top, 0.5, 0.3, EntityTypes=['VALUE'],
+                               Relationships=[{'Type': 'CHILD', 'Ids': children}])
+        self.__block__('KEY_VALUE_SET', page, top, 0.1, 0.3, EntityTypes=['KEY'], Relationships=[
+            {'Type': 'VALUE', 'Ids': [value['Id']]},
+            {'Type': 'CHILD', 'Ids': self.__words__(page, key, top, 0.1)}])
+
+    """
+    Returns the blocks in the order Textract would, which does not put parents before children
+    """
+    def finish(self):
+        self.rng.shuffle(self.blocks)
+        return self.blocks
+
+    def __words__(self, page, text, top, left):
+        ids = []
+        for word in text.split():
+            ids.append(self.__block__('WORD', page, top, left, 0.01 * len(word), Text=word, TextType='PRINTED')['Id'])
+            left += 0.01 * (len(word) + 1)
+        return ids
+
+    def __block__(self, block_type, page, top, left, width, relationships=None, **fields):
+        self.count += 1
+        height = 0.01
+        block = {'BlockType': block_type, 'Confidence': self.rng.uniform(80.0, 99.9),
+                 'Geometry': {'BoundingBox': {'Width': width, 'Height': height, 'Left': left, 'Top': top},
+                              'Polygon': [{'X': left, 'Y': top}, {'X': left + width, 'Y': top},
+                                          {'X': left + width, 'Y': top + height}, {'X': left, 'Y': top + height}]},
+                 'Id': f'{self.count:08x}-0000-4000-8000-{self.rng.getrandbits(48):012x}', 'Page': page}
+        block.update(fields)
+        if relationships is not None:
+            block['Relationships'] = [{'Type': 'CHILD', 'Ids': relationships}]
+        self.blocks.append(block)
+        return block
+
+"""
+A stand-in for the spacy model that labels the synthetic names as PERSON and years as DATE
+without any inference, so the benchmark measures everything around the model
+"""
+class StubModel():
+    meta = {'lang': 'en', 'name': 'stub', 'version': '0'}
+    names = set(FIRST_NAMES) | set(LAST_NAMES)
+    year = re.compile(r'\b(19|20)\d\d\b')
+
+    def pipe(self, texts, batch_size=64, n_process=1):
+        for text in texts:
+            ents = []
+            if any(word.strip(',.') in self.names for word in text.split()):
+                ents.append((text, 'PERSON'))
+            if self.year.search(text):
+                ents.append((text, 'DATE'))
+            yield tuple(ents)
+
+"""
+Generates the documents of a run, already serialized like the files in S3
+
+Parameters
+----------
+docs: (int) the number of documents
+
+incomplete: (float) the share of documents without name and graduation date pairs, which
+                    makes them go through Phase 2
+
+pages, pairs, lines, fanout: see generateDocument(...)
+
+Returns
+-------
+documents: (list) a (kv.json, raw.json) tuple of bytes per document
+"""
+def generateCorpus(docs, incomplete=0.25, pages=2, pairs=40, lines=80, fanout=3):
+    documents = []
+    for seed in range(docs):
+        kv_json, raw_json = generateDocument(pages, pairs, lines, fanout, seed,
+                                             complete=seed % 100 >= incomplete * 100)
+        documents.append((json.dumps(kv_json).encode('utf-8'), json.dumps(raw_json).encode('utf-8')))
+    return documents
+
+"""
+Runs the benchmark
+
+Parameters
+----------
+documents: (list) as returned by generateCorpus(...)
+
+META: (dictionary) meta.data as loaded by loadData(...)
+
+ner: (string) 'stub' for StubModel or 'real' for the spacy model
+
+gazetteer: (boolean) whether strings the name lists can decide skip the model (see NameGazetteer)
+
+Returns
+-------
+results: (dictionary) 'docs_per_sec', 'peak_memory' in bytes, 'ner' statistics and the
+                      latency percentiles in milliseconds of every stage under 'stages'
+"""
+def run(documents, META, ner='stub', gazetteer=False):
+    model = StubModel() if ner == 'stub' else NERModel.getModel()
+
+    def newCache():
+        return NERCache(model, gazetteer=NameGazetteer() if gazetteer else None)
+
+    timings = {stage: [] for stage in STAGES}
+    null = open(os.devnull, 'w')
+
+    # Every stage on its own, fed with the output of the stage before it
+    NERModel.__cache__ = newCache()
+    with contextlib.redirect_stdout(null):
+        for kv_bytes, raw_bytes in documents:
+            kv_blocks = json.loads(kv_bytes)['Blocks']
+            raw_index = pipeline.toIndex(json.loads(raw_bytes)['Blocks'])  # As TextractStream gives it
+
+            __time__(timings['parse'], lambda: (loadResponse(io.BytesIO(kv_bytes)),
+                                                loadResponse(io.BytesIO(raw_bytes))))
+            index, key_ids, confidence = __time__(timings['extractIds'], lambda: pipeline.extractIds(kv_blocks))
+            __time__(timings['getText'], lambda: [pipeline.getText(row, index) for row in range(len(index.text))
+                                                  if index.children[row] is not None])
+            mappings = __time__(timings['getMapping'], lambda: pipeline.getMapping(index, key_ids))
+            __time__(timings['getRawText'], lambda: pipeline.getRawText(raw_index))
+            __time__(timings['detectEntityKV'], lambda: EntityDetector(META).detectEntityKV(mappings))
+            missing = getFields(META)
+            region_lines = __time__(timings['getRegionLines'],
+                                    lambda: pipeline.getRegionLines(raw_index, missing, META))[0]
+            __time__(timings['detectEntity'], lambda: RawEntDetector(META).detectEntity(missing, region_lines))
+
+    # The whole pipeline, starting from a cold cache
+    NERModel.__cache__ = newCache()
+    with contextlib.redirect_stdout(null):
+        for kv_bytes, raw_bytes in documents:
+            __time__(timings['document'], lambda: pipeline.main(
+                loadResponse(io.BytesIO(kv_bytes)), lambda: loadResponse(io.BytesIO(raw_bytes)), META))
+    cache = NERModel.__cache__.stats()
+
+    # Peak memory of the pipeline, in a separate pass since tracing slows everything down
+    NERModel.__cache__ = newCache()
+    tracemalloc.start()
+    with contextlib.redirect_stdout(null):
+        for kv_bytes, raw_bytes in documents:
+            pipeline.main(loadResponse(io.BytesIO(kv_bytes)), lambda: loadResponse(io.BytesIO(raw_bytes)), META)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    null.close()
+
+    stages = {}
+    for stage, values in timings.items():
+        values = sorted(values)
+        stages[stage] = {'mean': sum(values) / len(values), 'p50': percentile(values, 50),
+                         'p90': percentile(values, 90), 'p99': percentile(values, 99)}
+    return {'docs_per_sec': len(documents) / (sum(timings['document']) / 1000),
+            'peak_memory': peak, 'ner': cache, 'stages': stages}
+
+"""
+Benchmarks date normalization (see DateNormalizer.py) against the dateutil-only processDate it
+replaced, on the values of every key-value pair in the corpus. Most values are not dates, which
+is the case the old function handled worst
+
+Parameters
+----------
+documents: (list) as returned by generateCorpus(...)
+
+Returns
+-------
+results: (dictionary) microseconds per value of 'legacy' (dateutil only), 'cold' (an empty memo)
+                      and 'warm' (a filled memo), the number of 'values' and how many results
+                      'differ' between legacy and the normalizer
+"""
+def benchmarkDates(documents):
+    values = []
+    for kv_bytes, raw_bytes in documents:
+        mappings = pipeline.getKVMappings(json.loads(kv_bytes)['Blocks'])[0]
+        values.extend(v['Value'] for v in mappings.values())
+
+    def legacy(date):
+        try:
+            return parser.parse(date).strftime('%Y')
+        except ValueError:
+            return 'NA'
+
+    start = time.perf_counter()
+    before = [legacy(value) for value in values]
+    legacy_time = time.perf_counter() - start
+
+    DateNormalizer.normalizeDate.cache_clear()
+    start = time.perf_counter()
+    after = [DateNormalizer.normalizeDate(value) for value in values]
+    cold_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for value in values:
+        DateNormalizer.normalizeDate(value)
+    warm_time = time.perf_counter() - start
+
+    # Ranges are meant to differ, since dateutil cannot read them at all
+    differ = sum(1 for a, b in zip(before, after) if a != b)
+    per_value = 1e6 / max(len(values), 1)
+    return {'values': len(values), 'differ': differ, 'legacy': legacy_time * per_value,
+            'cold': cold_time * per_value, 'warm': warm_time * per_value}
+
+"""
+Gets a percentile of sorted values, interpolating between the two closest ranks
+
+Parameters
+----------
+values: (list) sorted numbers
+
+q: (float) the percentile, from 0 to 100
+
+Returns
+-------
+value: (float) the q-th percentile
+"""
+def percentile(values, q):
+    position = (len(values) - 1) * q / 100
+    low = int(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+"""
+Prints the results of a run and, if a baseline is given, how every stage changed
+
+Parameters
+----------
+results: (dictionary) as returned by run(...)
+
+baseline: (dictionary) the results of an earlier run, as saved with --save
+
+tolerance: (float) how much slower (0.1 is 10%) a stage's median may get before it is reported
+                   as a regression
+
+Returns
+-------
+regressions: (list) the stages, or 'docs_per_sec', that got slower than the tolerance allows
+"""
+def report(results, baseline=None, tolerance=0.1):
+    print(f'{results["docs_per_sec"]:.1f} docs/sec, peak memory {results["peak_memory"] / 2 ** 20:.1f} MiB')
+    print(f'NER: {results["ner"]}')
+    print(f'{"stage":<16}{"mean":>10}{"p50":>10}{"p90":>10}{"p99":>10}{"baseline p50":>15}{"change":>9}')
+
+    regressions = []
+    for stage, stats in results['stages'].items():
+        line = f'{stage:<16}' + ''.join(f'{stats[k]:>10.3f}' for k in ('mean', 'p50', 'p90', 'p99'))
+        if baseline is not None and stage in baseline['stages']:
+            before = baseline['stages'][stage]['p50']
+            change = stats['p50'] / before - 1 if before > 0 else 0.0
+            line += f'{before:>15.3f}{change:>+9.1%}'
+            if change > tolerance:
+                regressions.append(stage)
+                line += '  REGRESSION'
+        print(line)
+
+    if baseline is not None:
+        change = results['docs_per_sec'] / baseline['docs_per_sec'] - 1
+        print(f'docs/sec {change:+.1%} against the baseline ({baseline["docs_per_sec"]:.1f})')
+        if change < -tolerance:
+            regressions.append('docs_per_sec')
+        if baseline.get('config') != results.get('config'):
+            print(f'Warning: the baseline was run with {baseline.get("config")}')
+    return regressions
+
+"""
+Times one call and records it in milliseconds
+
+Returns
+-------
+result: the result of the call
+"""
+def __time__(timings, call):
+    start = time.perf_counter()
+    result = call()
+    timings.append((time.perf_counter() - start) * 1000)
+    return result
+
+if __name__ == '__main__':
+    arguments = argparse.ArgumentParser(description='Benchmarks the extraction stages on synthetic Textract output')
+    arguments.add_argument('--docs', type=int, default=50)
+    arguments.add_argument('--pages', type=int, default=2)
+    arguments.add_argument('--pairs', type=int, default=40)
+    arguments.add_argument('--lines', type=int, default=80)
+    arguments.add_argument('--fanout', type=int, default=3)
+    arguments.add_argument('--incomplete', type=float, default=0.25)
+    arguments.add_argument('--ner', choices=['stub', 'real'], default='stub')
+    arguments.add_argument('--save', help='file destination to save the results to as a baseline')
+    arguments.add_argument('--baseline', help='results saved by an earlier run to compare against')
+    arguments.add_argument('--tolerance', type=float, default=0.1)
+    arguments.add_argument('--dates', action='store_true', help='also benchmark date normalization')
+    arguments.add_argument('--gazetteer', action='store_true', help='decide clear names without the model')
+    args = arguments.parse_args()
+
+    config = {'docs': args.docs, 'pages': args.pages, 'pairs': args.pairs, 'lines': args.lines,
+              'fanout': args.fanout, 'incomplete': args.incomplete, 'ner': args.ner,
+              'gazetteer': args.gazetteer}
+    META = pipeline.loadData(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'meta.data'))
+    documents = generateCorpus(args.docs, args.incomplete, args.pages, args.pairs, args.lines, args.fanout)
+    results = run(documents, META, args.ner, args.gazetteer)
+    results['config'] = config
+    if args.dates:
+        results['dates'] = benchmarkDates(documents)
+        dates = results['dates']
+        print(f'Dates: {dates["values"]} values, {dates["legacy"]:.1f} us each with dateutil only, '
+              f'{dates["cold"]:.1f} us cold and {dates["warm"]:.1f} us warm, {dates["differ"]} results differ')
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+    regressions = report(results, baseline, args.tolerance)
+    if args.save:
+        with open(args.save, 'w') as fp:
+            json.dump(results, fp, indent=4)
+    # The corpus has no ranges, so any date the normalizer reads differently from dateutil fails the run
+    mismatches = args.dates and results['dates']['differ'] > 0
+    sys.exit(1 if regressions or mismatches else 0)
@@ -0,0 +1,147 @@
+from array import array
+
+"""
+A compact index over the blocks of one Textract response. It is built once and every stage
+reads from it: extractIds, getMapping/getText and getRawText. Block IDs are interned to
+integer rows and the fields the stages read are kept in flat columns. CHILD and VALUE
+relationships are stored as lists of row numbers. A block can be referenced before it has
+been added (Textract does not order parents before children). Its row is reserved at that
+point and filled in when the block arrives. Rows that are never filled keep BlockType
+MISSING.
+
+Parameters
+----------
+blocks: (iterable) each element is a dictionary that represents a single block of information
+                   identified from the OCR extraction ('Id', 'EntityType', 'BlockType', 'Text',
+                   'Relationships', 'Confidence', etc.)
+"""
+class BlockIndex():
+    __slots__ = ('ids', 'types', 'entity', 'selected', 'page', 'top', 'left', 'confidence',
+                 'text', 'children', 'values', 'count', 'conf_sum', 'key_rows', 'line_rows')
+
+    MISSING = 0
+    BLOCK_TYPES = ['MISSING', 'PAGE', 'LINE', 'WORD', 'KEY_VALUE_SET', 'SELECTION_ELEMENT',
+                   'TABLE', 'CELL', 'MERGED_CELL', 'TITLE', 'QUERY', 'QUERY_RESULT', 'SIGNATURE',
+                   'LAYOUT_TEXT', 'OTHER']
+    CODES = {name: code for code, name in enumerate(BLOCK_TYPES)}
+    LINE = CODES['LINE']
+    WORD = CODES['WORD']
+    KEY_VALUE_SET = CODES['KEY_VALUE_SET']
+    SELECTION_ELEMENT = CODES['SELECTION_ELEMENT']
+
+    def __init__(self, blocks=()):
+        self.ids = {}  # Textract block Id -> row
+        self.types = array('B')  # BlockType code of each row
+        self.entity = array('B')  # 1 if the row is a KEY, 2 if it is a VALUE, 0 otherwise
+        self.selected = array('B')  # 1 if the row is a SELECTED selection element
+        self.page = array('H')
+        self.top = array('d')
+        self.left = array('d')
+        self.confidence = array('d')
+        self.text = []
+        self.children = []  # Rows of the CHILD relationships of each row, None if there are none
+        self.values = []  # Rows of the VALUE relationships of each row, None if there are none
+        self.count = 0  # Blocks added, which is not the number of rows if some are MISSING
+        self.conf_sum = 0.0
+        self.key_rows = array('I')
+        self.line_rows = array('I')
+        for block in blocks:
+            self.add(block)
+
+    """
+    Adds one Textract block to the index. Only the fields the extraction stages read are kept
+
+    Parameters
+    ----------
+    block: (dictionary) represents a single block of information identified from the OCR
+                        extraction
+    """
+    def add(self, block):
+        row = self.__intern__(block['Id'])
+        code = self.CODES.get(block['BlockType'], self.CODES['OTHER'])
+        self.types[row] = code
+        self.count += 1
+
+        if 'Confidence' in block:
+            self.confidence[row] = block['Confidence']
+            self.conf_sum += block['Confidence']
+        if 'Text' in block:
+            self.text[row] = block['Text']
+        if 'Page' in block:
+            self.page[row] = block['Page']
+        if 'Geometry' in block:
+            box = block['Geometry']['BoundingBox']
+            self.top[row] = box['Top']
+            self.left[row] = box['Left']
+        if block.get('SelectionStatus') == 'SELECTED':
+            self.selected[row] = 1
+
+        if code == self.KEY_VALUE_SET:
+            if 'KEY' in block['EntityTypes']:
+                self.entity[row] = 1
+                self.key_rows.append(row)
+            else:
+                self.entity[row] = 2
+        elif code == self.LINE:
+            self.line_rows.append(row)
+
+        for relationship in block.get('Relationships', ()):
+            if relationship['Type'] == 'CHILD':
+                self.children[row] = self.__rows__(self.children[row], relationship['Ids'])
+            elif relationship['Type'] == 'VALUE':
+                self.values[row] = self.__rows__(self.values[row], relationship['Ids'])
+
+    """
+    The average confidence of OCR readings over every block added, in the same way
+    extractIds(...) has always calculated it
+
+    Returns
+    -------
+    confidence: (float) the sum of block confidences divided by the number of blocks
+    """
+    def averageConfidence(self):
+        return self.conf_sum / self.count
+
+    """
+    Checks whether a row holds an actual block, not just a reference to one
+
+    Parameters
+    ----------
+    row: (int) a row of the index
+
+    Returns
+    -------
+    exists: (boolean) True if the block of the row was added
+    """
+    def exists(self, row):
+        return self.types[row] != self.MISSING
+
+    """
+    Reserves a row for a block Id the first time it is seen
+    """
+    def __intern__(self, block_id):
+        row = self.ids.get(block_id)
+        if row is None:
+            row = len(self.text)
+            self.ids[block_id] = row
+            self.types.append(self.MISSING)
+            self.entity.append(0)
+            self.selected.append(0)
+            self.page.append(0)
+            self.top.append(0.0)
+            self.left.append(0.0)
+            self.confidence.append(0.0)
+            self.text.append(None)
+            self.children.append(None)
+            self.values.append(None)
+        return row
+
+    """
+    Converts a list of related block Ids to rows, appending to the rows already known
+    """
+    def __rows__(self, rows, block_ids):
+        if rows is None:
+            rows = array('I')
+        for block_id in block_ids:
+            rows.append(self.__intern__(block_id))
+        return rows
@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+import threading
+from NERModel import getGazetteer
+
+"""
+A manifest of the transcripts an extraction run has already finished, so that a run that
+dies partway through (Lambda timeout, spot-instance loss) can be started again without
+redoing the transformer inference for them. Each line of the manifest is a JSON record of
+one transcript: its 'ARN', the ETags of its 'kv.json' and 'raw.json' and the hash of the
+meta.data and name lists it was extracted with (see configHash). A transcript is only skipped
+if all three still match, so new transcripts, transcripts whose OCR was redone and every
+transcript after a meta.data or name list change are extracted again. Records are appended once the form is stored in DynamoDB, so a
+line in the manifest always means the output exists.
+
+Parameters
+----------
+path: (string) file destination of the manifest. Created if it does not exist
+
+META: (dictionary) a mapping of different of key words (aliases) and words that indicate wrong
+                   selection (antialiases) to our desired metadata, as loaded from meta.data
+"""
+class Checkpoint():
+
+    def __init__(self, path, META):
+        self.path = path
+        self.config = configHash(META)
+        self.records = {}
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as fp:
+                for line in fp:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # The last line of a run that was killed while writing it
+                    self.records[record['ARN']] = record  # Later records replace earlier ones
+        self.fp = open(path, 'a')
+
+    """
+    Checks whether a transcript was already extracted from the same inputs and meta.data
+
+    Parameters
+    ----------
+    arn: (string) the folder name of the transcript
+
+    etags: (dictionary) the current ETag of 'kv.json' and 'raw.json' of the transcript
+
+    Returns
+    -------
+    done: (boolean) True if the transcript can be skipped
+    """
+    def done(self, arn, etags):
+        record = self.records.get(arn)
+        return (record is not None and record['config'] == self.config
+                and record['kv'] == etags.get('kv.json') and record['raw'] == etags.get('raw.json'))
+
+    """
+    Records that a transcript was extracted and stored. The record is flushed to disk right away
+
+    Parameters
+    ----------
+    arn: (string) the folder name of the transcript
+
+    etags: (dictionary) the ETag of 'kv.json' and 'raw.json' the transcript was extracted from
+    """
+    def record(self, arn, etags):
+        record = {'ARN': arn, 'kv': etags.get('kv.json'), 'raw': etags.get('raw.json'), 'config': self.config}
+        with self.lock:
+            self.records[arn] = record
+            self.fp.write(json.dumps(record) + '\n')
+            self.fp.flush()
+
+    """
+    Closes the manifest file
+    """
+    def close(self):
+        self.fp.close()
+
+"""
+Hashes the meta.data a run uses along with the name gazetteer that decides entities before the
+model, so that a change to any alias or antialias, turning the gazetteer on or off, or editing
+its word lists makes every transcript stale
+
+Parameters
+----------
+META: (dictionary) meta.data as loaded by loadData(...). The compiled 'matcher' is left out
+                   since it is built from the rest
+
+Returns
+-------
+digest: (string) the SHA-256 of the configuration
+"""
+def configHash(META):
+    config = {k: v for k, v in META.items() if k != 'matcher'}
+    gazetteer = getGazetteer()
+    config['gazetteer'] = gazetteer.digest if gazetteer is not None else None  # None when disabled
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()
@@ -0,0 +1,146 @@
+import re
+from calendar import monthrange
+from functools import lru_cache
+from dateutil import parser
+
+"""
+Turns the text of a date into the year it names. The formats transcripts use most (a bare
+year, MM/DD/YYYY, YYYY-MM-DD, 'June 2001', 'June 1, 2001' and ranges such as '2014-2018')
+are matched with precompiled patterns, and only the text none of them match goes through
+dateutil, which is much slower and signals non-dates with an exception. A date a pattern
+matches but cannot vouch for (e.g., 13/01/2001, which dateutil reads day first) is also left
+to dateutil, so the fast path never disagrees with it. Text without a digit can only be a
+date to dateutil if it names a month or weekday, so the rest (most key-value values) is
+rejected without raising its exception. Results are memoized per raw string.
+"""
+MONTHS = r'(?:jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|june?|july?|aug(?:ust)?|sep(?:t(?:ember)?)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?)'
+MONTH_NUMBERS = {name: number for number, name in enumerate(
+    ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec'], start=1)}
+
+# A digit, or a month or weekday name dateutil knows as a word of its own (the '-' and '.' of
+# 'Smith-June' or 'Mon.' separate words for dateutil too). Text without either is never a date
+DATE_WORDS = sorted({name.lower() for names in parser.parserinfo.MONTHS + parser.parserinfo.WEEKDAYS
+                     for name in names}, key=len, reverse=True)
+MAYBE_DATE = re.compile(r'\d|(?<![^\W\d_])(?:' + '|'.join(DATE_WORDS) + r')(?![^\W\d_])', re.IGNORECASE)
+
+YEAR = re.compile(r'[12]\d{3}')
+NUMERIC = re.compile(r'(\d{1,2})([/.-])(\d{1,2})\2([12]\d{3})')  # MM/DD/YYYY, MM-DD-YYYY, MM.DD.YYYY
+ISO = re.compile(r'([12]\d{3})([/-])(\d{1,2})\2(\d{1,2})')  # YYYY-MM-DD
+MONTH_YEAR = re.compile(MONTHS + r'\.?,?\s+([12]\d{3})', re.IGNORECASE)  # June 2001
+MONTH_DAY_YEAR = re.compile(r'(' + MONTHS + r')\.?\s+(\d{1,2})(?:st|nd|rd|th)?,?\s+([12]\d{3})', re.IGNORECASE)
+RANGE = re.compile(r'([12]\d{3})\s*(?:-|–|—|to)\s*([12]\d{3})', re.IGNORECASE)  # 2014-2018
+# Any of the above inside a longer line of text, longest formats first
+DATE = re.compile(r'(?<![\w/.-])(?:' + '|'.join([RANGE.pattern, MONTH_DAY_YEAR.pattern, MONTH_YEAR.pattern,
+                                                 r'\d{1,2}[/.-]\d{1,2}[/.-][12]\d{3}',
+                                                 r'[12]\d{3}[/-]\d{1,2}[/-]\d{1,2}', YEAR.pattern])
+                  + r')(?![\w/-])', re.IGNORECASE)
+
+"""
+Finds the year of a date
+
+Parameters
+----------
+date: (string) the text of a date (e.g., '06/01/2001' or 'June 2001'), or 'NA'
+
+Returns
+-------
+year: (string) the four digit year of the date, the end year of a range, or 'NA' if the
+               text is not a date
+"""
+@lru_cache(maxsize=8192)
+def normalizeDate(date):
+    year = fastYear(date)
+    if year is not None:
+        return year
+    return parseYear(date)
+
+"""
+Finds the year of a date in one of the common formats
+
+Parameters
+----------
+date: (string) the text of a date
+
+Returns
+-------
+year: (string) the year, 'NA' for text that is certainly not a date, or None if the text has
+               to go through dateutil
+"""
+def fastYear(date):
+    text = date.strip()
+    if text == '' or text == 'NA' or not MAYBE_DATE.search(text):
+        return 'NA'
+
+    if YEAR.fullmatch(text):
+        return text
+
+    match = NUMERIC.fullmatch(text)
+    if match:
+        first, second, year = int(match.group(1)), int(match.group(3)), int(match.group(4))
+        # Month first, as dateutil reads it. Anything else is left to dateutil
+        return match.group(4) if __valid__(year, first, second) else None
+
+    match = ISO.fullmatch(text)
+    if match:
+        year, month, day = int(match.group(1)), int(match.group(3)), int(match.group(4))
+        return match.group(1) if __valid__(year, month, day) else None
+
+    match = MONTH_YEAR.fullmatch(text)
+    if match:
+        return match.group(1)
+
+    match = MONTH_DAY_YEAR.fullmatch(text)
+    if match:
+        month = MONTH_NUMBERS[match.group(1)[:3].lower()]
+        year, day = int(match.group(3)), int(match.group(2))
+        return match.group(3) if __valid__(year, month, day) else None
+
+    match = RANGE.fullmatch(text)
+    if match:
+        return match.group(2)
+
+    return None
+
+"""
+Finds the dates written in a line of text
+
+Parameters
+----------
+text: (string) a line of text (e.g., 'Graduated June 2001')
+
+Returns
+-------
+dates: (list) the (start, end, year) of every date in the text, in order, where start and end
+              are the position of the date in the text
+"""
+def findDates(text):
+    dates = []
+    for match in DATE.finditer(text):
+        year = normalizeDate(match.group(0))
+        if year != 'NA':
+            dates.append((match.start(), match.end(), year))
+    return dates
+
+"""
+Finds the year of a date in any format dateutil understands. This is how processDate has
+always worked
+
+Parameters
+----------
+date: (string) the text of a date
+
+Returns
+-------
+year: (string) the year, or 'NA' if dateutil cannot read the text as a date
+"""
+def parseYear(date):
+    try:
+        return parser.parse(date).strftime('%Y')
+    except (ValueError, OverflowError):
+        return 'NA'
+
+"""
+Checks that a month and day exist in a year
+"""
+def __valid__(year, month, day):
+    return 1 <= month <= 12 and 1 <= day <= monthrange(year, month)[1]
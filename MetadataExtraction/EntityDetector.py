@@ -1,24 +1,89 @@
-import spacy
-from dateutil import parser
+import re
+import numpy as np
+from AliasMatcher import AliasMatcher
+from DateNormalizer import normalizeDate
+from Metrics import log, metrics
+from NERModel import getCache
 
 """
-Handles analysis of transcript key-value pairs
+The metadata types extracted when meta.data does not declare its own "types". Each type names
+the spacy entity label that supports it, the form fields it fills and how its selected value is
+parsed: 'name' splits it into a first and last name, 'year' keeps the year of a date and 'text'
+keeps the value as it is. 'ranges' lets Phase 2 take the end of a year range with no alias
+(see RawEntDetector)
+"""
+TYPES = {
+    'Name': {'entity': 'PERSON', 'fields': ['First', 'Last'], 'parse': 'name'},
+    'Grad': {'entity': 'DATE', 'fields': ['Grad'], 'parse': 'year', 'ranges': True},
+}
+
+"""
+Gets the metadata types to extract
+
+Parameters
+----------
+META: (dictionary) meta.data as loaded by loadData(...)
+
+Returns
+-------
+types: (dictionary) key is a metadata type (e.g., 'Name') and is mapped to its 'entity',
+                    'fields' and 'parse' (see TYPES), in the order of meta.data
+"""
+def getTypes(META):
+    return META.get('types', TYPES)
+
+"""
+Lists the form fields of every metadata type
+
+Parameters
+----------
+META: (dictionary) meta.data as loaded by loadData(...)
+
+Returns
+-------
+fields: (list) the names of the fields of a form (e.g., ['First', 'Last', 'Grad'])
+"""
+def getFields(META):
+    return [field for spec in getTypes(META).values() for field in spec['fields']]
+
+"""
+Handles analysis of transcript key-value pairs. Every key-value pair of a document is scored
+against every metadata type declared in meta.data at once: the alias, NER and position terms
+are matrices with a row per pair and a column per type, so a new type is only a change to
+meta.data and adds a column rather than another pass over the pairs
+
+Parameters
+----------
+META: (dictionary) aliases and antialiases of our desired metadata, as loaded by loadData(...)
+
+prune: (boolean) if True, NER is skipped for key-value pairs that cannot pass the score
+                 threshold no matter what entities the transformer would find in them
 """
 class EntityDetector():
-    nlp = spacy.load('en_core_web_trf')  # NLP Class Variable
 
-    # Defines the association between metadata we wish to find and the named entity that spacy detects it as
-    translator = {'Name': 'PERSON',
-                  'DOB': 'DATE',
-                  'Grad': 'DATE'}
+    threshold = 2  # A key-value pair must score more than this to be considered metadata
+    word = re.compile(r'\w+')  # No value holds more entities than it has words
 
-    def __init__(self, META):
+    def __init__(self, META, prune=True):
         self.META = META
-        self.form = {
-            'First': 'NA',
-            'Last': 'NA',
-            'Grad': 'NA',
-        }
+        self.prune = prune
+        self.ner_calls = 0  # Values of the last document sent to NER
+        self.ner_saved = 0  # Values of the last document that skipped NER thanks to pruning
+        self.cache = getCache()  # Shared model and entities of previously seen text
+        self.matcher = META['matcher'] if 'matcher' in META else AliasMatcher(META)
+        self.types = getTypes(META)
+
+        # Defines the association between metadata we wish to find and the named entity that spacy detects it as
+        self.translator = {name: spec['entity'] for name, spec in self.types.items()}
+        self.labels = {}  # Entity label -> columns of the types it supports
+        for column, label in enumerate(self.translator.values()):
+            self.labels.setdefault(label, []).append(column)
+        # Column of every type in the matcher's counts. Types without aliases read a column of zeros
+        self.columns = [self.matcher.types.index(name) if name in self.matcher.types else len(self.matcher.types)
+                        for name in self.types]
+
+        self.form = dict.fromkeys(getFields(META), 'NA')
+        self.__pairs__ = None  # The last mappings scored and their matrices (see __getPairs__)
 
     """
     Identify if a key-value pair is metadata and (if so) what piece of matadata is it
@@ -27,29 +92,27 @@ class EntityDetector():
     ----------
     k: (string) the text extracted from a key in a key-value pair from a given document
     v: (string) the text extracted from a value in a key-value pair from a given document
+
+    ents: (tuple) the (text, label) entities spacy found in the title-cased value. Found here
+                  if not given
     
     Returns
     -------
     local_max: (string) represents the type of metadata that this key-value pair
-                        most likely belongs to (e.g., 'First' or 'Last' or 'Grad')
+                        most likely belongs to (e.g., 'Name' or 'Grad')
                         
     score: (float) a rating of how confident we are this key-value pair is the one
-                   we are looking for. Calculated based on how many times an alias 
-                   appeared in the key or value and its positioning from the top of
-                   the page--rewarding a pair that is closer to the top
+                   we are looking for, before its position is added
     """
-    def classify(self, k, v):
-        k = k.title()
-        v = v.title()
-        local_scores = {}
-        local_scores['Name'] = self.__getScore__(k, v, 'Name')
-        local_scores['Grad'] = self.__getScore__(k, v, 'Grad')
-        local_max = max(local_scores, key=local_scores.get)
-        score = local_scores[local_max]
-        return local_max, score
+    def classify(self, k, v, ents=None):
+        if ents is None:
+            ents = self.cache.entities(v.title())
+        scores = self.__getLexical__([k], [v]) + 2 * self.__getNER__([ents])
+        column = int(scores[0].argmax())
+        return list(self.types)[column], float(scores[0, column])
 
     """
-    Extracts the first name, last name, and graduation year if the information is found in a transcript
+    Extracts the metadata of every type in meta.data if the information is found in a transcript
     
     Parameters
     ----------
@@ -58,6 +121,9 @@ class EntityDetector():
                            maps to the value text found in the field and 'Top' which represents
                            the relative percentage distance this key-value pair was from the top
                            of the document
+
+    entities: (dictionary) maps every string from getValues(mappings) to the (text, label) entities
+                           spacy found in it. If not given, NER is run here as one batch
     
     Returns
     -------
@@ -65,38 +131,95 @@ class EntityDetector():
                    desired metadata are the keys and the selected information from fields in
                    a transcript are the values (e.g. what the first name is)
     """
-    def detectEntityKV(self, mappings):
-        scores = {
-            'Name': {},
-            'Grad': {},
-        }
-        for k, v in mappings.items():
-            # local_max is a string that represents the classified metadata, e.g., 'First'
-            # score is the awarded points for similarity to the classified metadata
-            if len(v['Value']) > 0:
-                local_max, score = self.classify(k, v['Value'])
-                score += (1-v['Top'])
-
-                if score > 2:
-                    scores[local_max].update({
-                        k: {
-                             'Value': v['Value'],
-                             'Score': score
-                             }
-                    })
-
-        # Get first and last name
-        first, last = self.__getName__(scores['Name'])
-        self.form['First'] = first
-        self.form['Last'] = last
-
-        # Get the grad date
-        grad = self.__getMax__(scores['Grad'])
-        grad = self.processDate(grad)
-        self.form['Grad'] = grad
+    def detectEntityKV(self, mappings, entities=None):
+        # Run NER once over every distinct value so that all metadata types share the results
+        if entities is None:
+            values = self.getValues(mappings)
+            entities = dict(zip(values, self.cache.pipe(values)))
+
+        with metrics.span('scoring'):
+            keys, values, lexical, position, passing = self.__getPairs__(mappings)
+
+            # Score of every pair (row) as every type (column). Pairs that cannot pass have no entities
+            rows = np.flatnonzero(passing)
+            scores = lexical + position[:, None]
+            scores[rows] += 2 * self.__getNER__([entities[values[row].title()] for row in rows])
+
+            best = scores.argmax(axis=1)  # Ties go to the type declared first
+            score = scores[np.arange(len(keys)), best]
+            selected = passing & (score > self.threshold)
+
+        for column, (name, spec) in enumerate(self.types.items()):
+            candidates = {keys[row]: {'Value': values[row], 'Score': float(score[row])}
+                          for row in np.flatnonzero(selected & (best == column))}
+            self.form.update(zip(spec['fields'], self.__parse__(spec, candidates)))
 
         return self.form
 
+    """
+    Lists the strings that detectEntityKV needs named entities for. Values of pairs that cannot
+    pass the score threshold are left out and counted in ner_saved
+
+    Parameters
+    ----------
+    mappings: (dictionary) key is the field name found in a document, and is mapped to another
+                           dictionary with 'Value' and 'Top' (see detectEntityKV)
+
+    Returns
+    -------
+    values: (list) the title-cased text of every non-empty value that still needs NER
+    """
+    def getValues(self, mappings):
+        keys, values, lexical, position, passing = self.__getPairs__(mappings)
+        needed = [values[row].title() for row in np.flatnonzero(passing)]
+        skipped = {values[row].title() for row in np.flatnonzero(~passing)}
+
+        self.ner_calls = len(set(needed))
+        self.ner_saved = len(skipped.difference(needed))
+        metrics.count('ner_values', self.ner_calls)
+        metrics.count('ner_pruned', self.ner_saved)
+        return needed
+
+    """
+    Scores the non-empty key-value pairs of a document on everything but NER. getValues and
+    detectEntityKV both need this, so the matrices of the last mappings are kept
+
+    Parameters
+    ----------
+    mappings: (dictionary) key is the field name found in a document, and is mapped to another
+                           dictionary with 'Value' and 'Top' (see detectEntityKV)
+
+    Returns
+    -------
+    keys: (list) the key text of every pair with a value
+
+    values: (list) the value text of the same pairs
+
+    lexical: (array) the alias score of every pair and type (see __getLexical__)
+
+    position: (array) 1 - 'Top' of every pair, which rewards a pair closer to the top
+
+    passing: (array) False for the pairs that cannot pass the score threshold whatever entities
+                     NER finds. Every entity of the right label adds 2, so the highest possible
+                     score assumes each word of the value is its own such entity
+    """
+    def __getPairs__(self, mappings):
+        if self.__pairs__ is not None and self.__pairs__[0] is mappings:
+            return self.__pairs__[1]
+
+        keys = [k for k, v in mappings.items() if len(v['Value']) > 0]
+        values = [mappings[k]['Value'] for k in keys]
+        lexical = self.__getLexical__(keys, values)
+        position = 1 - np.array([mappings[k]['Top'] for k in keys], dtype=float)
+        if self.prune:
+            most_ents = np.array([len(self.word.findall(value)) for value in values], dtype=float)
+            passing = lexical.max(axis=1) + 2 * most_ents + position > self.threshold
+        else:
+            passing = np.ones(len(keys), dtype=bool)
+
+        self.__pairs__ = (mappings, (keys, values, lexical, position, passing))
+        return self.__pairs__[1]
+
     """
     Finds the highest score for a given piece of metadata
     
@@ -158,7 +281,7 @@ class EntityDetector():
                     break
             if not existsFirst or not existsLast:
                 name = self.__getMax__(names)
-                print(name)
+                log.debug(name)
                 if ',' in name:
                     splitted_name = name.split(sep=',')
                     splitted_name[0] = splitted_name[0].strip(' ')
@@ -180,77 +303,95 @@ class EntityDetector():
         return first, last
 
     """
-    Gives a key-value block a score for how well it relates to metadata
-    
+    Counts the entities that support each metadata type (e.g., 'PERSON' for 'Name')
+
     Parameters
     ----------
-    key: (string) the text representation of the key identified in a key-value
-                  pair in a document
-    
-    value: (string) the text representation of the value identified in a key-value
-                    pair in a document
-                    
-    name: (string) tells the natural language processor what kind of information we
-                   should expect to see (e.g., 'First', 'Last', Grad). If 'First'
-                   or 'Last', should be a 'PERSON'. If 'Grad', should be a 'DATE'
-    
+    ents: (list) the (text, label) entities spacy found in each value
+
     Returns
     -------
-    score: (float) a rating of how confident we are this key-value pair is the one
-                   we are looking for. Calculated based on how many times an alias 
-                   appeared in the key or value and its positioning from the top of
-                   the page--rewarding a pair that is closer to the top
+    ner: (array) the number of entities of every value (row) with the label of every type (column)
     """
-    def __getScore__(self, key, value, name):
-        score = 0
-        ner = self.translator[name]
-
-        key_aliases = self.META['key'][name]['alias']
-        key_anti_aliases = self.META['key'][name]['antialias']
-        value_aliases = self.META['value'][name]['alias']
-        value_anti_aliases = self.META['value'][name]['antialias']
-
-        temp_key = key.lower()
-        temp_value = value.lower()
-
-        for key_alias in key_aliases:  # reward if the key text contains aliases
-            if key_alias in temp_key:
-                score += 1
-        for key_anti_alias in key_anti_aliases:  # reduce score if the key text contains anti aliases
-            if key_anti_alias in temp_key:
-                score -= 10
-        for value_alias in value_aliases:
-            if value_alias in temp_value:
-                score += 2
-        for value_anti_alias in value_anti_aliases:
-            if value_anti_alias in temp_value:
-                score -= 10
-
-        doc = self.nlp(value)  # if the NLP recognizes an appropriate metadata, increment score
-        for ent in doc.ents:
-            if ent.label_ == ner:
-                print(f'Person: {ent.text}')
-                score += 2
-
-        return score
+    def __getNER__(self, ents):
+        ner = np.zeros((len(ents), len(self.types)))
+        for row, found in enumerate(ents):
+            # if the NLP recognizes an appropriate metadata, increment score
+            for text, label in found:
+                for column in self.labels.get(label, ()):
+                    log.debug('%s: %s', label, text)
+                    ner[row, column] += 1
+        return ner
+
+    """
+    Scores key-value pairs on the aliases and antialiases found in their key and value text,
+    which is everything in a score except the NER and position terms
+
+    Parameters
+    ----------
+    keys: (list) the text representation of the key of each key-value pair in a document
+
+    values: (list) the text representation of the value of the same key-value pairs
+
+    Returns
+    -------
+    lexical: (array) the alias score of every pair (row) as every metadata type (column)
+    """
+    def __getLexical__(self, keys, values):
+        key_hits = self.__getHits__(keys, 'key')
+        value_hits = self.__getHits__(values, 'value')
+
+        lexical = (key_hits[:, 0]  # reward if the key text contains aliases
+                   - 10 * key_hits[:, 1]  # reduce score if the key text contains anti aliases
+                   + 2 * value_hits[:, 0]
+                   - 10 * value_hits[:, 1])
+        return lexical.astype(float)
+
+    """
+    Counts the aliases and antialiases of every type in our order (see AliasMatcher.matrix)
+    """
+    def __getHits__(self, texts, side):
+        hits = self.matcher.matrix([text.lower() for text in texts], side)
+        hits = np.pad(hits, ((0, 0), (0, 0), (0, 1)))  # The column of types without aliases
+        return hits[:, :, self.columns]
+
+    """
+    Turns the candidates of a metadata type into the values of its fields
+
+    Parameters
+    ----------
+    spec: (dictionary) the 'fields' and 'parse' of the type (see TYPES)
+
+    candidates: (dictionary) key is the field name found in a document, and is mapped to another
+                             dictionary with the 'Value' and 'Score' of a pair selected as the type
+
+    Returns
+    -------
+    values: (tuple) the value of each field of the type, 'NA' if there is no candidate
+    """
+    def __parse__(self, spec, candidates):
+        if spec['parse'] == 'name':
+            return self.__getName__(candidates)
+        value = self.__getMax__(candidates)
+        if spec['parse'] == 'year':
+            value = self.processDate(value)
+        return (value,)
 
     """
-    Converts a date to the YYYY/MM/DD format
+    Converts a date to the YYYY/MM/DD format. Common formats are read with regular expressions
+    and only the rest goes through dateutil (see DateNormalizer.py)
     
     Parameters
     ----------
     date: (string) represents some way of spelling a date. Can be number denotation, month name denotation, etc.
-                   (e.g., '4/6/2001', 'August 7, 2012')
+                   (e.g., '4/6/2001', 'August 7, 2012', '2014-2018')
     
     Returns
     -------
     dt_proc: (string) a string of the year of the graduation date in a standardized format of just the year
     """
     def processDate(self, date):
-        try:
-            dt = parser.parse(date)
-            dt_proc = dt.strftime("%Y")  # If this doesn't work, then dt.strftime("%Y/%m/%d")
-        except ValueError:
-            print('Warning. \'Date\' key does not map to a Date value.')
-            dt_proc = 'NA'
+        dt_proc = normalizeDate(date)  # If this doesn't work, then dt.strftime("%Y/%m/%d")
+        if dt_proc == 'NA' and date != 'NA':
+            log.debug('Warning. \'Date\' key does not map to a Date value.')
         return dt_proc
@@ -0,0 +1,206 @@
+import random
+import threading
+import time
+from Metrics import log, metrics
+
+# Error codes AWS uses when a request is throttled rather than rejected
+THROTTLING = {'ThrottlingException', 'ProvisionedThroughputExceededException', 'LimitExceededException',
+              'RequestLimitExceeded', 'TooManyRequestsException'}
+
+"""
+Stores extracted forms in DynamoDB in batches instead of one put_item per transcript. Forms
+are buffered and written with batch_write_item 25 at a time (the API's limit). Items DynamoDB
+leaves unprocessed are sent again with backoff. The buffer is flushed when it is full, when
+the oldest form in it has waited flush_interval seconds and when the writer is closed, so a
+form never waits on the next transcript for long. Use it as a context manager so the last
+forms are written on shutdown.
+
+Parameters
+----------
+db: (client) a boto3 DynamoDB client
+
+table: (string) the text representation of the name of the DynamoDB table
+
+flush_interval: (float) the most seconds a form waits in the buffer. None to only flush when
+                        the buffer is full or the writer is closed
+
+retries: (int) the number of times a batch is sent again before its items are given up on
+
+stored: (function) if given, called with the ARN of every form once DynamoDB has accepted it
+"""
+class FormWriter():
+    BATCH = 25
+
+    def __init__(self, db, table='Final251', flush_interval=5.0, retries=8, stored=None):
+        self.db = db
+        self.stored = stored
+        self.table = table
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.buffer = {}  # ARN -> item, so a transcript written twice in one batch is sent once
+        self.oldest = None
+        self.written = 0
+        self.failed = []
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.timer = None
+        if flush_interval is not None:
+            self.timer = threading.Thread(target=self.__watch__, daemon=True)
+            self.timer.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    """
+    Adds a form to the buffer, writing the buffer if it is full
+
+    Parameters
+    ----------
+    form: (dictionary) a mapping of metadata names to extracted information, along with the
+                       'ARN' of the transcript the information came from
+    """
+    def add(self, form):
+        with self.lock:
+            if not self.buffer:
+                self.oldest = time.monotonic()
+            self.buffer[form['ARN']] = toItem(form)
+            if len(self.buffer) < self.BATCH:
+                return
+            items = self.__take__()
+        self.__write__(items)
+
+    """
+    Writes every form in the buffer
+    """
+    def flush(self):
+        with self.lock:
+            items = self.__take__()
+        self.__write__(items)
+
+    """
+    Writes the forms left in the buffer and stops the timer. Forms DynamoDB never accepted are
+    kept in failed
+    """
+    def close(self):
+        self.closed.set()
+        if self.timer is not None:
+            self.timer.join()
+        self.flush()
+        if self.failed:
+            log.error(f'{len(self.failed)} forms could not be stored in {self.table}')
+
+    """
+    Empties the buffer. Must be called with the lock held
+    """
+    def __take__(self):
+        items = list(self.buffer.values())
+        self.buffer = {}
+        self.oldest = None
+        return items
+
+    """
+    Flushes the buffer once the oldest form in it has waited flush_interval seconds
+    """
+    def __watch__(self):
+        while not self.closed.wait(self.flush_interval / 4):
+            with self.lock:
+                due = self.oldest is not None and time.monotonic() - self.oldest >= self.flush_interval
+                items = self.__take__() if due else []
+            self.__write__(items)
+
+    """
+    Writes items to DynamoDB, timed as a db_write span
+
+    Parameters
+    ----------
+    items: (list) DynamoDB items as returned by toItem(...)
+    """
+    def __write__(self, items):
+        if items:
+            with metrics.span('db_write'):
+                self.__send__(items)
+
+    """
+    Sends items to DynamoDB, 25 per batch_write_item call, retrying what is left unprocessed
+
+    Parameters
+    ----------
+    items: (list) DynamoDB items as returned by toItem(...)
+    """
+    def __send__(self, items):
+        for i in range(0, len(items), self.BATCH):
+            requests = {self.table: [{'PutRequest': {'Item': item}} for item in items[i:i + self.BATCH]]}
+            attempt = 0
+            while requests:
+                try:
+                    response = self.db.batch_write_item(RequestItems=requests)
+                    unprocessed = response.get('UnprocessedItems') or {}
+                except Exception as e:
+                    code = getattr(e, 'response', {}).get('Error', {}).get('Code')
+                    if code not in THROTTLING:
+                        log.error(f'Could not store forms in {self.table}: {e!r}')
+                        self.failed.extend(request['PutRequest']['Item'] for request in requests[self.table])
+                        break
+                    unprocessed = requests
+
+                self.__accepted__(requests[self.table], unprocessed.get(self.table, []))
+                requests = unprocessed
+                if requests:
+                    attempt += 1
+                    if attempt > self.retries:
+                        self.failed.extend(request['PutRequest']['Item'] for request in requests[self.table])
+                        break
+                    time.sleep(backoff(attempt))
+
+    """
+    Counts the items of a batch DynamoDB accepted and reports them to stored
+
+    Parameters
+    ----------
+    sent: (list) the put requests of the batch
+
+    unprocessed: (list) the put requests DynamoDB left unprocessed
+    """
+    def __accepted__(self, sent, unprocessed):
+        self.written += len(sent) - len(unprocessed)
+        if self.stored is None:
+            return
+        left = {request['PutRequest']['Item']['ARN']['S'] for request in unprocessed}
+        for request in sent:
+            arn = request['PutRequest']['Item']['ARN']['S']
+            if arn not in left:
+                self.stored(arn)
+
+"""
+Converts an extracted form to the DynamoDB item stored for it. Every text field is stored, so
+the fields of metadata types added to meta.data are stored too
+
+Parameters
+----------
+form: (dictionary) a mapping of metadata names to extracted information, along with the 'ARN'
+                   of the transcript the information came from
+
+Returns
+-------
+db_items: (dictionary) the form in proper format for DB
+"""
+def toItem(form):
+    db_items = {name: {'S': value} for name, value in form.items() if isinstance(value, str)}
+    return db_items
+
+"""
+The time to wait before a retry, with full jitter so that retries do not line up
+
+Parameters
+----------
+attempt: (int) how many times the batch has been sent again, starting at 1
+
+Returns
+-------
+delay: (float) seconds to wait
+"""
+def backoff(attempt, base=0.1, cap=10.0):
+    return random.uniform(0, min(cap, base * 2 ** attempt))
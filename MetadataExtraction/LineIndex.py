@@ -0,0 +1,83 @@
+from bisect import bisect_left, bisect_right
+
+"""
+A spatial index over the lines of a transcript. Lines are grouped by page and sorted by their
+distance from the top of the page, so the lines of a region (e.g., the top 30% of every page,
+or a signature block at the bottom of the last page) are found with two binary searches per
+page instead of a pass over the whole document. Built once per document; every region rule
+queries the same index. The index is built from the position columns alone, and the text of
+a line is only resolved for the lines a region returns.
+
+Parameters
+----------
+top, left, page: (sequence) the 'Top', 'Left' and page of each row (e.g., the columns of a
+                            BlockIndex or of the Lines of an artifact)
+
+text: (function) gives the text of a row
+
+rows: (sequence) the rows that are lines, in the order Textract found them. Every row if not
+                 given
+"""
+class LineIndex():
+
+    def __init__(self, top, left, page, text, rows=None):
+        self.rows = rows if rows is not None else range(len(top))
+        self.left = left
+        self.resolve = text
+        self.pages = {}  # page -> (sorted tops, lines in the same order)
+        heights = [top[row] for row in self.rows]
+        numbers = [page[row] for row in self.rows]
+        for line in sorted(range(len(heights)), key=heights.__getitem__):  # Stable, so ties keep their order
+            tops, lines = self.pages.setdefault(numbers[line], ([], []))
+            tops.append(heights[line])
+            lines.append(line)
+
+    """
+    Finds the lines inside a region of the page
+
+    Parameters
+    ----------
+    top: (tuple) the lowest and highest 'Top' of a line in the region, inclusive, as a percentage
+                 from the top of the page (0.1 is 10% from the top)
+
+    left: (tuple) if given, the lowest and highest 'Left' of a line in the region, inclusive
+
+    pages: (list) if given, the only pages searched. Negative pages count from the last page
+                  (-1 is the last page)
+
+    Returns
+    -------
+    lines: (list) the positions of the lines in the region, in the order Textract found them
+    """
+    def region(self, top=(0.0, 1.0), left=None, pages=None):
+        if pages is None:
+            pages = self.pages.keys()
+        else:
+            numbers = sorted(self.pages.keys())
+            pages = [numbers[page] if page < 0 and -page <= len(numbers) else page for page in pages]
+
+        found = []
+        for page in pages:
+            if page not in self.pages:
+                continue
+            tops, lines = self.pages[page]
+            for i in range(bisect_left(tops, top[0]), bisect_right(tops, top[1])):
+                line = lines[i]
+                if left is None or left[0] <= self.left[self.rows[line]] <= left[1]:
+                    found.append(line)
+        found.sort()
+        return found
+
+    """
+    Gets the text of lines without repeating a line that appears more than once
+
+    Parameters
+    ----------
+    lines: (list) positions as returned by region(...)
+
+    Returns
+    -------
+    text: (list) the distinct text of the lines, in the order of their first appearance
+    """
+    def text(self, lines):
+        return list(dict.fromkeys(self.resolve(self.rows[line]) for line in lines))
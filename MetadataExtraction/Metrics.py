@@ -0,0 +1,179 @@
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+"""
+Instrumentation for the extraction pipeline. Stages are timed with spans and events are
+counted with counters, both in a process-wide Metrics object:
+
+    with metrics.span('parse'):
+        ...
+    metrics.count('ner_inferred', len(missing))
+
+Spans: download (S3 request until the body starts streaming), parse (reading and decoding a
+Textract response; streamed responses are indexed while they are parsed), index (building the
+BlockIndex of a block list), mapping (getMapping), ner (strings the model actually runs on),
+scoring (EntityDetector.detectEntityKV without its NER), phase2 (fetching raw text and
+RawEntDetector, including its NER) and db_write (storing forms in a sink).
+
+Counters: documents, phase2_documents, ner_values and ner_pruned (key-value values sent to NER
+or skipped by pruning), gazetteer_match, gazetteer_miss and gazetteer_ambiguous (strings the name
+lists decided with or without a PERSON, or left to the model), ner_inferred and ner_chars
+(strings and characters the model ran on, after the gazetteer and the cache).
+
+Set METRICS_PATH to keep the metrics. A path ending in .prom is written as a Prometheus
+textfile with the totals of this process; anything else gets one JSON line per span plus a
+line with the totals on every flush. '{pid}' in the path is replaced by the process id, which
+parallel workers need so that they do not overwrite each other's textfile. Runs flush after
+every transcript (every group in batch mode), so spans are not held in memory for the whole
+run and a killed run loses at most the last one.
+
+Per-document output goes to the 'extraction' logger at DEBUG level (see log).
+"""
+log = logging.getLogger('extraction')
+
+"""
+Collects the spans and counters of this process
+
+Parameters
+----------
+path: (string) file destination of the metrics (see above). None to only keep them in memory
+"""
+class Metrics():
+
+    def __init__(self, path=None):
+        self.template = path
+        self.local = threading.local()
+        self.reset()
+
+    """
+    Drops everything collected so far. Worker processes call this when they start, since a
+    forked worker inherits the spans, counters and path of its parent
+    """
+    def reset(self):
+        self.lock = threading.Lock()  # A fork can copy the parent's lock while it is held
+        self.path = self.template.format(pid=os.getpid()) if self.template else None
+        self.prometheus = bool(self.template) and self.template.endswith('.prom')
+        self.seconds = {}  # Span name -> total seconds
+        self.calls = {}  # Span name -> number of spans
+        self.counters = {}
+        self.events = []  # JSON lines not yet written
+
+    """
+    Times a block of code
+
+    Parameters
+    ----------
+    name: (string) the stage being timed (e.g., 'parse')
+
+    document: (string) the transcript the stage works on. Defaults to the one set with
+                       document(...) on this thread
+    """
+    @contextmanager
+    def span(self, name, document=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.seconds[name] = self.seconds.get(name, 0.0) + elapsed
+                self.calls[name] = self.calls.get(name, 0) + 1
+                if self.path is not None and not self.prometheus:
+                    self.events.append({'span': name, 'seconds': elapsed, 'start': start,
+                                        'document': document or getattr(self.local, 'document', None),
+                                        'pid': os.getpid()})
+
+    """
+    Marks the transcript the current thread works on, so its spans are attributed to it
+
+    Parameters
+    ----------
+    arn: (string) the folder name of the transcript
+    """
+    @contextmanager
+    def document(self, arn):
+        previous = getattr(self.local, 'document', None)
+        self.local.document = arn
+        try:
+            yield
+        finally:
+            self.local.document = previous
+
+    """
+    Adds to a counter
+
+    Parameters
+    ----------
+    name: (string) the counter (e.g., 'ner_inferred')
+
+    value: (int) how much to add
+    """
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    """
+    Reports the totals of this process
+
+    Returns
+    -------
+    totals: (dictionary) 'seconds' and 'calls' of every span and the value of every counter
+    """
+    def totals(self):
+        with self.lock:
+            return {'seconds': dict(self.seconds), 'calls': dict(self.calls), 'counters': dict(self.counters)}
+
+    """
+    Writes what has been collected so far to path, if there is one
+    """
+    def flush(self):
+        if self.path is None:
+            return
+        totals = self.totals()
+        if self.prometheus:
+            # Written to a temporary file first so a scrape never reads half a file
+            with open(self.path + '.tmp', 'w') as fp:
+                fp.write(toPrometheus(totals))
+            os.replace(self.path + '.tmp', self.path)
+            return
+
+        with self.lock:
+            events = self.events
+            self.events = []
+        with open(self.path, 'a') as fp:
+            for event in events:
+                fp.write(json.dumps(event) + '\n')
+            fp.write(json.dumps(dict(totals, pid=os.getpid(), time=time.time())) + '\n')
+
+"""
+Formats totals in the Prometheus text exposition format
+
+Parameters
+----------
+totals: (dictionary) as returned by Metrics.totals()
+
+Returns
+-------
+text: (string) the contents of the textfile
+"""
+def toPrometheus(totals):
+    lines = ['# HELP extraction_stage_seconds_total Seconds spent in each stage of the extraction pipeline',
+             '# TYPE extraction_stage_seconds_total counter']
+    for name, seconds in sorted(totals['seconds'].items()):
+        lines.append(f'extraction_stage_seconds_total{{stage="{name}"}} {seconds}')
+    lines += ['# HELP extraction_stage_calls_total Times each stage of the extraction pipeline ran',
+              '# TYPE extraction_stage_calls_total counter']
+    for name, calls in sorted(totals['calls'].items()):
+        lines.append(f'extraction_stage_calls_total{{stage="{name}"}} {calls}')
+    for name, value in sorted(totals['counters'].items()):
+        lines.append(f'# TYPE extraction_{name}_total counter')
+        lines.append(f'extraction_{name}_total {value}')
+    return '\n'.join(lines) + '\n'
+
+metrics = Metrics(os.environ.get('METRICS_PATH'))
+atexit.register(metrics.flush)
@@ -0,0 +1,263 @@
+import json
+import os
+import sqlite3
+from collections import OrderedDict
+from contextlib import contextmanager
+from Metrics import metrics
+
+"""
+Caches the named entities that spacy finds in a string. Headers, school names and boilerplate
+lines repeat across thousands of transcripts, so the transformer only has to see each of them
+once. Results live in an in-memory LRU tier and, optionally, in an on-disk SQLite tier that
+survives between Lambda/batch runs. Cached results are tied to the model name and version and
+are dropped whenever either one changes. Strings a NameGazetteer can decide on its own never
+reach the cache or the model.
+
+Parameters
+----------
+nlp: (LocalModel or NERClient) the model to run on strings that are not cached (see NERModel)
+
+capacity: (int) the maximum number of strings kept in the memory tier
+
+path: (string) SQLite file for the disk tier. None keeps the cache in memory only
+
+gazetteer: (NameGazetteer) if given, asked first for the entities of every string
+"""
+class NERCache():
+
+    def __init__(self, nlp, capacity=10000, path=None, gazetteer=None):
+        self.nlp = nlp
+        self.gazetteer = gazetteer
+        self.capacity = capacity  # Maximum number of strings kept in the memory tier
+        self.path = path  # SQLite file for the disk tier, None keeps the cache in memory only
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.__disk__ = None
+        self.__pid__ = None
+        self.__identity__ = None  # (model, version), read from nlp only once the disk tier needs it
+
+    """
+    Normalizes a string so that the same text is cached under the same key no matter how
+    Textract spaced it. Case is kept since the transformer treats 'SMITH' and 'Smith' differently
+
+    Parameters
+    ----------
+    text: (string) any text extracted from a document
+
+    Returns
+    -------
+    key: (string) the text with surrounding whitespace removed and inner whitespace collapsed
+    """
+    @staticmethod
+    def normalize(text):
+        return ' '.join(text.split())
+
+    """
+    Finds the named entities of a string, only running the transformer if the string has not
+    been seen before
+
+    Parameters
+    ----------
+    text: (string) any text extracted from a document (e.g., a value or a line of raw text)
+
+    Returns
+    -------
+    ents: (tuple) a collection of (text, label) pairs for every entity spacy detected
+                  (e.g., (('John Smith', 'PERSON'),))
+    """
+    def entities(self, text):
+        key = self.normalize(text)
+
+        ents = self.__decide__(key)
+        if ents is None:
+            ents = self.__lookup__(key)
+        if ents is None:
+            self.misses += 1
+            metrics.count('ner_inferred')
+            metrics.count('ner_chars', len(key))
+            with metrics.span('ner'):
+                ents = next(iter(self.nlp.pipe([key])))
+            self.__store__([(key, ents)])
+        return ents
+
+    """
+    Finds the named entities of many strings at once. Strings that are not cached are
+    de-duplicated and sent through the transformer together as a single nlp.pipe batch
+
+    Parameters
+    ----------
+    texts: (list) a collection of strings extracted from a document
+
+    batch_size: (int) the number of strings the transformer processes at a time
+
+    n_process: (int) the number of processes spacy spreads the batch over
+
+    Returns
+    -------
+    ents: (list) the entities of each string, in the same order as texts
+    """
+    def pipe(self, texts, batch_size=64, n_process=1):
+        keys = [self.normalize(text) for text in texts]
+
+        found = {}
+        missing = []
+        for key in keys:
+            if key in found:
+                continue
+            ents = self.__decide__(key)
+            if ents is None:
+                ents = self.__lookup__(key)
+            if ents is None:
+                missing.append(key)
+                found[key] = None
+            else:
+                found[key] = ents
+
+        self.misses += len(missing)
+        if missing:
+            metrics.count('ner_inferred', len(missing))
+            metrics.count('ner_chars', sum(len(key) for key in missing))
+            with metrics.span('ner'):
+                inferred = list(zip(missing, self.nlp.pipe(missing, batch_size=batch_size, n_process=n_process)))
+            self.__store__(inferred)
+            found.update(inferred)
+
+        return [found[key] for key in keys]
+
+    """
+    Reports how well the cache is doing
+
+    Returns
+    -------
+    stats: (dictionary) hit and miss counters along with the current size of the memory tier,
+                        and the gazetteer's counters under 'Gazetteer' if there is one
+    """
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        stats = {
+            'Hits': self.hits,
+            'DiskHits': self.disk_hits,
+            'Misses': self.misses,
+            'HitRate': (self.hits + self.disk_hits) / lookups if lookups > 0 else 0.0,
+            'Size': len(self.memory),
+        }
+        if self.gazetteer is not None:
+            stats['Gazetteer'] = self.gazetteer.stats()
+        return stats
+
+    """
+    Names the model the cached entities belong to. Read from the model's metadata the first time
+    it is needed, so building a cache (or a detector) does not load spacy
+
+    Returns
+    -------
+    identity: (tuple) the model name (e.g., 'en_core_web_trf') and its version
+    """
+    def identity(self):
+        if self.__identity__ is None:
+            meta = self.nlp.meta
+            self.__identity__ = (f"{meta['lang']}_{meta['name']}", meta['version'])
+        return self.__identity__
+
+    """
+    Closes the disk tier, if there is one
+    """
+    def close(self):
+        if self.__disk__ is not None:
+            self.__disk__.close()
+            self.__disk__ = None
+
+    """
+    Asks the gazetteer for the entities of a normalized string. None if there is no gazetteer or
+    the string is ambiguous
+    """
+    def __decide__(self, key):
+        if self.gazetteer is None:
+            return None
+        return self.gazetteer.entities(key)
+
+    """
+    Looks a normalized string up in the memory tier and then the disk tier. Disk hits are
+    promoted to the memory tier
+    """
+    def __lookup__(self, key):
+        if key in self.memory:
+            self.hits += 1
+            self.memory.move_to_end(key)
+            return self.memory[key]
+
+        disk = self.__connect__()
+        if disk is not None:
+            row = disk.execute('SELECT ents FROM ents WHERE text = ?', (key,)).fetchone()
+            if row is not None:
+                self.disk_hits += 1
+                ents = tuple(tuple(ent) for ent in json.loads(row[0]))
+                self.__remember__(key, ents)
+                return ents
+        return None
+
+    """
+    Stores the entities of a batch of normalized strings in both tiers. The disk tier is written
+    in one transaction, so a batch costs one sync rather than one per string
+    """
+    def __store__(self, items):
+        for key, ents in items:
+            self.__remember__(key, ents)
+        disk = self.__connect__()
+        if disk is not None and items:
+            with self.__transaction__(disk):
+                disk.executemany('INSERT OR REPLACE INTO ents (text, ents) VALUES (?, ?)',
+                                 [(key, json.dumps(ents)) for key, ents in items])
+
+    """
+    Adds an entry to the memory tier, evicting the least recently used one when full
+    """
+    def __remember__(self, key, ents):
+        self.memory[key] = ents
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.capacity:
+            self.memory.popitem(last=False)
+
+    """
+    Opens the disk tier for the current process, clearing it if it was written by a different
+    model name or version. Connections are not shared with forked worker processes. Parallel
+    workers share the file, so it is opened in WAL mode with a busy timeout, and the model check
+    and reset happen in one write transaction that no other worker can interleave with
+    """
+    def __connect__(self):
+        if self.path is None:
+            return None
+        if self.__disk__ is not None and self.__pid__ == os.getpid():
+            return self.__disk__
+
+        disk = sqlite3.connect(self.path, timeout=30, isolation_level=None)  # Transactions are explicit
+        disk.execute('PRAGMA journal_mode=WAL')
+        with self.__transaction__(disk):
+            disk.execute('CREATE TABLE IF NOT EXISTS meta (model TEXT, version TEXT)')
+            disk.execute('CREATE TABLE IF NOT EXISTS ents (text TEXT PRIMARY KEY, ents TEXT)')
+            row = disk.execute('SELECT model, version FROM meta').fetchone()
+            identity = self.identity()
+            if row != identity:  # Stale or brand new cache
+                disk.execute('DELETE FROM ents')
+                disk.execute('DELETE FROM meta')
+                disk.execute('INSERT INTO meta (model, version) VALUES (?, ?)', identity)
+
+        self.__disk__ = disk
+        self.__pid__ = os.getpid()
+        return disk
+
+    """
+    Runs a block of writes as one transaction that holds the write lock from the start, rolling
+    it back if the block fails
+    """
+    @contextmanager
+    def __transaction__(self, disk):
+        disk.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            disk.execute('ROLLBACK')
+            raise
+        disk.execute('COMMIT')
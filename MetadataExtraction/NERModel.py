@@ -0,0 +1,140 @@
+import importlib.util
+import json
+import os
+from NERCache import NERCache
+from NameGazetteer import NAMES_PATH, NameGazetteer
+
+"""
+Gives every detector in a process the same named entity model and the same cache. The model
+is either spacy running in this process, loaded the first time it is needed rather than at
+import time, or a long-lived NERService process shared by many workers. Set the
+NER_SERVICE_ADDRESS environment variable to the service's Unix socket path, and NER_SERVICE_KEY
+to the key it was started with, to use the latter.
+Strings whose entities are clear from the name lists (see NameGazetteer.py) skip the model. Set
+NAMES_PATH to use another list of names, or to an empty string to send every string to the model.
+"""
+MODEL_NAME = 'en_core_web_trf'  # python -m spacy download en_core_web_trf
+
+__model__ = None
+__cache__ = None
+__gazetteer__ = None
+
+"""
+Runs a spacy model inside the current process. spacy itself is only imported once the model
+is first used, so processes that talk to NERService never pay for it
+
+Parameters
+----------
+name: (string) the name of the spacy pipeline to load (e.g., 'en_core_web_trf')
+"""
+class LocalModel():
+
+    def __init__(self, name=MODEL_NAME):
+        self.name = name
+        self.__nlp__ = None
+
+    """
+    Loads the spacy pipeline if it has not been loaded yet
+
+    Returns
+    -------
+    nlp: (Language) the loaded spacy pipeline
+    """
+    def load(self):
+        if self.__nlp__ is None:
+            import spacy
+            self.__nlp__ = spacy.load(self.name)
+        return self.__nlp__
+
+    """
+    The spacy metadata of the model, which includes its 'lang', 'name' and 'version'. Read from
+    the meta.json of the installed pipeline when it has not been loaded yet, so asking for it
+    does not load the transformer
+    """
+    @property
+    def meta(self):
+        if self.__nlp__ is None:
+            path = self.__metaPath__()
+            if path is not None:
+                with open(path, encoding='utf-8') as fp:
+                    return json.load(fp)
+        return self.load().meta
+
+    """
+    Finds the meta.json of the pipeline, whether it is a directory or an installed package, or
+    None if there is none
+    """
+    def __metaPath__(self):
+        directory = self.name
+        if not os.path.isdir(directory):
+            spec = importlib.util.find_spec(self.name) if self.name.isidentifier() else None
+            if spec is None or spec.origin is None:
+                return None
+            directory = os.path.dirname(spec.origin)
+        path = os.path.join(directory, 'meta.json')
+        return path if os.path.isfile(path) else None
+
+    """
+    Finds the named entities of a collection of strings
+
+    Parameters
+    ----------
+    texts: (list) a collection of strings
+
+    batch_size: (int) the number of strings the transformer processes at a time
+
+    n_process: (int) the number of processes spacy spreads the strings over
+
+    Returns
+    -------
+    ents: (generator) the (text, label) entities of each string, in the same order as texts
+    """
+    def pipe(self, texts, batch_size=64, n_process=1):
+        for doc in self.load().pipe(texts, batch_size=batch_size, n_process=n_process):
+            yield tuple((ent.text, ent.label_) for ent in doc.ents)
+
+"""
+Gets the named entity model for this process, creating it the first time
+
+Returns
+-------
+model: (LocalModel or NERClient) anything with 'meta' and pipe(texts, batch_size, n_process)
+"""
+def getModel():
+    global __model__
+    if __model__ is None:
+        address = os.environ.get('NER_SERVICE_ADDRESS')
+        if address:
+            from NERService import NERClient, getKey
+            __model__ = NERClient(address, getKey())
+        else:
+            __model__ = LocalModel()
+    return __model__
+
+"""
+Gets the name gazetteer for this process, loading the name lists the first time
+
+Returns
+-------
+gazetteer: (NameGazetteer) built from NAMES_PATH if that is set, or None if NAMES_PATH is empty
+"""
+def getGazetteer():
+    global __gazetteer__
+    path = os.environ.get('NAMES_PATH', NAMES_PATH)
+    if __gazetteer__ is None and path:
+        __gazetteer__ = NameGazetteer(path)
+    return __gazetteer__
+
+"""
+Gets the entity cache for this process, which every detector shares
+
+Returns
+-------
+cache: (NERCache) cache in front of getModel(), on disk at NER_CACHE_PATH if that is set, and
+                  behind getGazetteer()
+"""
+def getCache():
+    global __cache__
+    if __cache__ is None:
+        __cache__ = NERCache(getModel(), path=os.environ.get('NER_CACHE_PATH'), gazetteer=getGazetteer())
+    return __cache__
@@ -0,0 +1,47 @@
+"""
+Queues up text from many transcripts so that spacy sees it in large batches. A single
+document only has a handful of key-value values or top-of-page lines, which leaves most of
+the transformer's throughput unused. Documents submit their strings, the whole queue is sent
+through nlp.pipe at once, and every document gets back the entities of its own strings.
+"""
+class NERScheduler():
+
+    def __init__(self, cache, batch_size=64, n_process=1):
+        self.cache = cache  # NERCache that runs (and remembers) the inference
+        self.batch_size = batch_size  # Number of strings the transformer processes at a time
+        self.n_process = n_process  # Number of processes nlp.pipe spreads the queue over
+        self.queue = []
+        self.owners = []
+
+    """
+    Adds the strings of a document to the queue
+
+    Parameters
+    ----------
+    doc: (string) identifies the document the strings belong to (e.g., the transcript folder)
+
+    texts: (list) a collection of strings from the document that need named entities
+    """
+    def submit(self, doc, texts):
+        for text in texts:
+            self.queue.append(text)
+            self.owners.append(doc)
+
+    """
+    Runs NER over everything in the queue and empties it
+
+    Returns
+    -------
+    entities: (dictionary) key is a document that submitted strings, and is mapped to another
+                           dictionary from each of its strings to the (text, label) entities
+                           spacy found in it
+    """
+    def run(self):
+        entities = {}
+        ents = self.cache.pipe(self.queue, batch_size=self.batch_size, n_process=self.n_process)
+        for doc, text, ent in zip(self.owners, self.queue, ents):
+            entities.setdefault(doc, {})[text] = ent
+
+        self.queue = []
+        self.owners = []
+        return entities
@@ -0,0 +1,233 @@
+import os
+import sys
+import tempfile
+import threading
+import multiprocessing
+from multiprocessing.connection import Listener, Client
+from NERModel import LocalModel, MODEL_NAME
+
+"""
+A long-lived process that holds one warm copy of the transformer and answers named entity
+requests from extraction workers over a Unix socket. Workers only hold an NERClient, so the
+memory of each worker stays flat no matter how many of them share the model.
+
+Requests are tuples sent over a multiprocessing connection:
+    ('meta',)                    -> ('ok', meta)
+    ('pipe', texts, batch_size)  -> ('ok', [ents, ...]) where ents is a tuple of (text, label)
+Any failure is answered with ('error', message) and the connection stays open.
+
+Requests are unpickled, so only processes holding the key may connect: the service and every
+client read it from the NER_SERVICE_KEY environment variable, and neither starts without it. The
+socket must be in a directory only this user can access (mode 0700). Launch the service before
+the workers and point them at it, e.g.
+
+    export NER_SERVICE_KEY=$(python -c 'import secrets; print(secrets.token_hex(32))')
+    python NERService.py &          # prints the socket path, in a new private directory
+    export NER_SERVICE_ADDRESS=<that path>
+    python main.py ...
+
+or call startService() from the script that starts the workers.
+"""
+KEY_VARIABLE = 'NER_SERVICE_KEY'
+
+"""
+Reads the key that the service and its clients authenticate each other with
+
+Returns
+-------
+authkey: (bytes) the value of NER_SERVICE_KEY
+"""
+def getKey():
+    key = os.environ.get(KEY_VARIABLE)
+    if not key:
+        raise RuntimeError(f'{KEY_VARIABLE} must be set to use the NER service')
+    return key.encode()
+
+"""
+Makes a socket path in a new directory only this user can access
+
+Returns
+-------
+address: (string) path of a Unix socket that does not exist yet
+"""
+def privateAddress():
+    return os.path.join(tempfile.mkdtemp(prefix='ner-'), 'ner.sock')  # mkdtemp creates it with mode 0700
+
+"""
+Makes sure the directory of a socket exists and that only this user can access it
+
+Parameters
+----------
+address: (string) path of the Unix socket
+"""
+def checkDirectory(address):
+    directory = os.path.dirname(os.path.abspath(address))
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    info = os.stat(directory)
+    if info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise PermissionError(f'{directory} must be owned by this user with mode 0700 to hold the NER socket')
+
+"""
+Serves named entity requests forever
+
+Parameters
+----------
+address: (string) path of the Unix socket to listen on, in a directory with mode 0700
+
+name: (string) the name of the spacy pipeline to load
+
+authkey: (bytes) the key clients must present to connect
+
+ready: (Event) if given, set once the model is loaded and the socket is accepting connections
+"""
+def serve(address, name=MODEL_NAME, authkey=None, ready=None):
+    if not authkey:
+        raise ValueError('The NER service needs an authkey')
+    checkDirectory(address)
+    model = LocalModel(name)
+    model.load()  # Before ready is set, so no worker waits on the first request
+    meta = dict(model.meta)
+    lock = threading.Lock()  # Inference runs one batch at a time
+
+    if os.path.exists(address):
+        os.remove(address)
+    listener = Listener(address, family='AF_UNIX', authkey=authkey)
+    os.chmod(address, 0o600)
+    if ready is not None:
+        ready.set()
+
+    def handle(conn):
+        with conn:
+            while True:
+                try:
+                    request = conn.recv()
+                except EOFError:
+                    break
+                try:
+                    if request[0] == 'meta':
+                        conn.send(('ok', meta))
+                    elif request[0] == 'pipe':
+                        with lock:
+                            ents = list(model.pipe(request[1], batch_size=request[2]))
+                        conn.send(('ok', ents))
+                    else:
+                        conn.send(('error', f'Unknown request {request[0]!r}'))
+                except Exception as e:
+                    conn.send(('error', repr(e)))
+
+    with listener:
+        while True:
+            conn = listener.accept()
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+"""
+Starts the service in a child process and waits for the model to finish loading. Workers
+started afterwards use it once NER_SERVICE_ADDRESS is set to the returned address
+
+Parameters
+----------
+address: (string) path of the Unix socket to listen on. A new private directory if not given
+
+name: (string) the name of the spacy pipeline to load
+
+authkey: (bytes) the key clients must present to connect. Read from NER_SERVICE_KEY if not given
+
+Returns
+-------
+process: (Process) the running service. Call terminate() on it when the workers are done
+
+address: (string) path of the Unix socket the service listens on
+"""
+def startService(address=None, name=MODEL_NAME, authkey=None):
+    if authkey is None:
+        authkey = getKey()
+    if address is None:
+        address = privateAddress()
+    checkDirectory(address)
+    ready = multiprocessing.Event()
+    process = multiprocessing.Process(target=serve, args=(address, name, authkey, ready), daemon=True)
+    process.start()
+    while not ready.wait(timeout=1):
+        if not process.is_alive():
+            raise RuntimeError(f'NER service exited with code {process.exitcode}')
+    return process, address
+
+"""
+Talks to a running NER service. Can be used anywhere a LocalModel is used. Each process opens
+its own connection the first time it sends a request
+
+Parameters
+----------
+address: (string) path of the Unix socket the service listens on
+
+authkey: (bytes) the key the service was started with. Read from NER_SERVICE_KEY if not given
+"""
+class NERClient():
+
+    def __init__(self, address, authkey=None):
+        self.address = address
+        self.authkey = authkey if authkey is not None else getKey()
+        self.__conn__ = None
+        self.__pid__ = None
+        self.__meta__ = None
+
+    """
+    The spacy metadata of the model the service runs
+    """
+    @property
+    def meta(self):
+        if self.__meta__ is None:
+            self.__meta__ = self.__request__('meta')
+        return self.__meta__
+
+    """
+    Finds the named entities of a collection of strings using the service
+
+    Parameters
+    ----------
+    texts: (list) a collection of strings
+
+    batch_size: (int) the number of strings the transformer processes at a time
+
+    n_process: (int) unused. The service decides how inference is run
+
+    Returns
+    -------
+    ents: (list) the (text, label) entities of each string, in the same order as texts
+    """
+    def pipe(self, texts, batch_size=64, n_process=1):
+        texts = list(texts)
+        if len(texts) == 0:
+            return []
+        return [tuple(tuple(ent) for ent in ents) for ents in self.__request__('pipe', texts, batch_size)]
+
+    """
+    Closes the connection of this process
+    """
+    def close(self):
+        if self.__conn__ is not None:
+            self.__conn__.close()
+            self.__conn__ = None
+
+    """
+    Sends a request and waits for its answer, reconnecting in forked processes
+    """
+    def __request__(self, *request):
+        if self.__conn__ is None or self.__pid__ != os.getpid():
+            self.__conn__ = Client(self.address, family='AF_UNIX', authkey=self.authkey)
+            self.__pid__ = os.getpid()
+        self.__conn__.send(request)
+        status, result = self.__conn__.recv()
+        if status != 'ok':
+            raise RuntimeError(f'NER service failed: {result}')
+        return result
+
+"""
+Runs the service from the command line, e.g. NER_SERVICE_KEY=... python NERService.py, which
+listens in a new private directory, or python NERService.py ~/.ner/ner.sock
+"""
+if __name__ == '__main__':
+    key = getKey()
+    address = sys.argv[1] if len(sys.argv) > 1 else privateAddress()
+    print(address, flush=True)
+    serve(address, authkey=key)
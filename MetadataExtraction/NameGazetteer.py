@@ -0,0 +1,149 @@
+import hashlib
+import os
+import re
+from DateNormalizer import findDates
+from Metrics import metrics
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+NAMES_PATH = os.path.join(HERE, 'names.txt')
+WORDS_PATH = os.path.join(HERE, 'words.txt')
+
+TOKEN = re.compile(r"[^\W\d_]+(?:['’-][^\W\d_]+)*")  # Words, including O'Brien and Smith-Jones
+NAME_GAP = re.compile(r'[\s,.]*')  # What may separate the words of one name (e.g., 'Smith, John A.')
+DIGIT = re.compile(r'\d')
+
+"""
+Decides the named entities of a string without the transformer when the answer is clear. The
+words of the string are looked up in a set of given names and surnames and a set of common
+transcript words that are never part of a name, both loaded from plain word lists. A string made
+only of known names, initials and common words is a clear 'match' (each run of names is a PERSON)
+or 'miss' (no PERSON), and its dates, found with the patterns of DateNormalizer.py, are its DATE
+entities. Anything else (an unknown word, a number that is not a date, a word that is both a name
+and a common word) is 'ambiguous' and left to the model. Only PERSON and DATE are produced, the
+only labels EntityDetector and RawEntDetector read
+
+Parameters
+----------
+names: (string) file of given names and surnames, one per line. Lines starting with # are skipped
+
+words: (string) file of common words that are never part of a name, in the same format
+"""
+class NameGazetteer():
+
+    def __init__(self, names=NAMES_PATH, words=WORDS_PATH):
+        digest = hashlib.sha256()
+        self.names = self.__load__(names, digest)
+        self.words = self.__load__(words, digest)
+        self.digest = digest.hexdigest()  # Identifies both lists, so checkpoints notice when they change
+        self.counts = {'match': 0, 'miss': 0, 'ambiguous': 0}
+
+    """
+    Finds the named entities of a string if the word lists are enough to tell them
+
+    Parameters
+    ----------
+    text: (string) any text extracted from a document (e.g., a value or a line of raw text)
+
+    Returns
+    -------
+    ents: (tuple) the (text, label) entities like spacy would give them, or None if the string
+                  is ambiguous and has to go through the model
+    """
+    def entities(self, text):
+        ents = self.__classify__(text)
+        if ents is None:
+            kind = 'ambiguous'
+        elif any(label == 'PERSON' for _, label, _ in ents):
+            kind = 'match'
+        else:
+            kind = 'miss'
+        self.counts[kind] += 1
+        metrics.count('gazetteer_' + kind)
+        return None if ents is None else tuple((ent, label) for ent, label, _ in ents)
+
+    """
+    Reports how many strings were decided without the model
+
+    Returns
+    -------
+    stats: (dictionary) the number of 'Match', 'Miss' and 'Ambiguous' strings and the share of
+                        strings that skipped the model
+    """
+    def stats(self):
+        total = sum(self.counts.values())
+        return {
+            'Match': self.counts['match'],
+            'Miss': self.counts['miss'],
+            'Ambiguous': self.counts['ambiguous'],
+            'DecidedRate': (self.counts['match'] + self.counts['miss']) / total if total > 0 else 0.0,
+        }
+
+    """
+    Finds the entities of a string with their position, or None if it is ambiguous
+    """
+    def __classify__(self, text):
+        ents = []
+        # Dates are taken out first so that their month names and numbers are not read as words
+        for start, end, year in findDates(text):
+            ents.append((text[start:end], 'DATE', start))
+            text = text[:start] + ' ' * (end - start) + text[end:]
+        if DIGIT.search(text):
+            return None  # Numbers that are not dates (e.g., '06/2018' or 'Grade 12')
+
+        run = None  # [start, end, has a name] of the name being read
+        for token in TOKEN.finditer(text):
+            kind = self.__kind__(token.group(0))
+            if kind is None:
+                return None
+            if kind == 'word':
+                self.__close__(run, text, ents)
+                run = None
+            elif run is not None and NAME_GAP.fullmatch(text, run[1], token.start()):
+                run[1] = token.end()
+                run[2] = run[2] or kind == 'name'
+            else:
+                self.__close__(run, text, ents)
+                run = [token.start(), token.end(), kind == 'name']
+        self.__close__(run, text, ents)
+
+        ents.sort(key=lambda ent: ent[2])
+        return ents
+
+    """
+    Adds a run of names and initials as a PERSON, unless it only holds initials (e.g., a grade)
+    """
+    def __close__(self, run, text, ents):
+        if run is not None and run[2]:
+            ents.append((text[run[0]:run[1]], 'PERSON', run[0]))
+
+    """
+    Looks a word up in both lists
+
+    Returns
+    -------
+    kind: (string) 'initial' (a single letter), 'name' or 'word', or None if the word is unknown
+                   or in both lists
+    """
+    def __kind__(self, token):
+        word = token.lower().replace("'", '').replace('’', '')
+        if len(word) == 1:
+            return 'initial'
+        name = word in self.names or all(part in self.names for part in word.split('-'))
+        common = word in self.words
+        if name and common:
+            return None
+        if name:
+            return 'name'
+        if common:
+            return 'word'
+        return None
+
+    """
+    Reads a word list into a frozenset, adding its contents to the digest of the lists
+    """
+    def __load__(self, path, digest):
+        with open(path, encoding='utf-8') as fp:
+            text = fp.read()
+        digest.update(hashlib.sha256(text.encode('utf-8')).digest())
+        return frozenset(line.strip().lower() for line in text.splitlines()
+                         if line.strip() and not line.startswith('#'))
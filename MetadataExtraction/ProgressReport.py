@@ -1,6 +1,7 @@
-import matplotlib.pyplot as plt
 import json
-import numpy as np
+import math
+
+BINS = [0,5,10,15,20,25,30,35,40,45,50,55,60,65,70,75,80,85,90,95,100]  # Confidence histogram edges
 
 """
 Plots a histogram based on a sample of confidences from OCR extractions
@@ -11,13 +12,14 @@ conf: (list) a collection of floats each representing the average confidence of
              extraction on a document
 """
 def plotConf(conf):
+    import matplotlib.pyplot as plt
     fig = plt.figure(figsize=(10, 5))
     plt.style.use('seaborn-whitegrid')
     plt.xlim((0, 100))
-    plt.hist(conf, bins=[0,5,10,15,20,25,30,35,40,45,50,55,60,65,70,75,80,85,90,95,100], facecolor='#2ab0ff', edgecolor='#169acf')
+    plt.hist(conf, bins=BINS, facecolor='#2ab0ff', edgecolor='#169acf')
     plt.xlabel('Confidence %')
     plt.ylabel('Number of Observations')
-    plt.title('Histogram of 500 Transcript Confidence Readings')
+    plt.title(f'Histogram of {len(conf)} Transcript Confidence Readings')
     plt.show()
 
 """
@@ -31,18 +33,240 @@ forms: (list) a collection of dictionaries where the key is a string of the tran
               to what the algorithm was able to select for each
 """
 def report(forms):
-    conf = []
+    reporter = Reporter()
     for form in forms:
-        conf.append(form['Confidence'])
+        reporter.add(form)
+
     output = open('results.txt', 'w')
     output.write('Transcript Extraction Report\n'
-                 '500 transcripts analyzed\n\n'
+                 f'{reporter.count} transcripts analyzed\n\n'
 
                  'Confidence scores:\n'
-                 f'     Mean: {np.mean(conf)}\n'
-                 f'     SD: {np.std(conf)}\n\n'
+                 f'     Mean: {reporter.mean}\n'
+                 f'     SD: {reporter.sd()}\n\n'
                  )
-    output.write(json.dumps(forms, indent=4, sort_keys=True))
+    # Same text as json.dumps(forms, indent=4, sort_keys=True), one form at a time
+    output.write('[')
+    for i, form in enumerate(forms):
+        output.write(',\n    ' if i > 0 else '\n    ')
+        output.write(json.dumps(form, indent=4, sort_keys=True).replace('\n', '\n    '))
+    output.write('\n]' if len(forms) > 0 else ']')
     output.close()
 
-    plotConf(conf)
+    plotConf([form['Confidence'] for form in forms])
+
+"""
+Builds the extraction report while forms are being produced, without keeping them in memory.
+Each form is appended to a JSON Lines results file as it arrives, and the confidences are
+summarized with a running (Welford) mean and variance and the counts of a fixed-bin
+histogram. Reports of parallel workers or separate runs are combined with merge(...), and
+the histogram is only drawn, with matplotlib imported at that point, when render(...) is
+called. Forwards every form to a sink if given one, so lambda_handler can use it in place
+of its sink.
+
+A results file that already exists (e.g., a run resumed from its checkpoint) is appended to,
+and the forms already in it are counted in the statistics, so the saved summary covers the
+whole file. Each form is flushed before it reaches the sink, whose checkpoint record then
+means its report line is on disk.
+
+Parameters
+----------
+path: (string) file destination of the JSON Lines results. None to only keep the statistics
+
+sink: (DynamoSink, JSONLSink or SQLiteSink) if given, where forms are stored as well
+"""
+class Reporter():
+
+    def __init__(self, path=None, sink=None):
+        self.path = path
+        self.sink = sink
+        self.fp = None
+        self.count = 0  # Forms with a confidence
+        self.mean = 0.0
+        self.m2 = 0.0  # Sum of squared distances from the mean
+        self.histogram = [0] * (len(BINS) - 1)
+        self.incomplete = 0  # Forms with metadata left as 'NA'
+        if path is not None:
+            self.__resume__(path)
+            self.fp = open(path, 'a')
+
+    def __enter__(self):
+        if self.sink is not None:
+            self.sink.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    """
+    Forwards the checkpoint callback to the sink (see Checkpoint)
+    """
+    @property
+    def stored(self):
+        return self.sink.stored if self.sink is not None else None
+
+    @stored.setter
+    def stored(self, stored):
+        if self.sink is not None:
+            self.sink.stored = stored
+
+    """
+    Adds an extracted form to the report
+
+    Parameters
+    ----------
+    form: (dictionary) a mapping of metadata names to extracted information, with the
+                       'Confidence' of its OCR extraction
+    """
+    def add(self, form):
+        if self.fp is not None:
+            self.fp.write(json.dumps(form, sort_keys=True) + '\n')
+            self.fp.flush()  # Before the sink records the transcript as done
+        self.__count__(form)
+        if self.sink is not None:
+            self.sink.add(form)
+
+    """
+    Adds a form to the statistics
+    """
+    def __count__(self, form):
+        if 'NA' in form.values():
+            self.incomplete += 1
+        if 'Confidence' in form:
+            confidence = form['Confidence']
+            self.count += 1
+            delta = confidence - self.mean
+            self.mean += delta / self.count
+            self.m2 += delta * (confidence - self.mean)
+            self.histogram[self.__bin__(confidence)] += 1
+
+    """
+    The standard deviation of the confidences, over the whole population like np.std
+
+    Returns
+    -------
+    sd: (float) the standard deviation, or nan if there are no confidences yet
+    """
+    def sd(self):
+        return math.sqrt(self.m2 / self.count) if self.count > 0 else math.nan
+
+    """
+    Adds the statistics of another report to this one, as if its forms had been added here.
+    Their results files are not combined
+
+    Parameters
+    ----------
+    other: (Reporter or dictionary) a report, or its summary()
+    """
+    def merge(self, other):
+        if isinstance(other, dict):
+            other = Reporter.fromSummary(other)
+        count = self.count + other.count
+        if count > 0:
+            delta = other.mean - self.mean
+            self.m2 += other.m2 + delta * delta * self.count * other.count / count
+            self.mean += delta * other.count / count
+        self.count = count
+        self.histogram = [a + b for a, b in zip(self.histogram, other.histogram)]
+        self.incomplete += other.incomplete
+
+    """
+    Returns
+    -------
+    summary: (dictionary) the statistics of the report, which can be saved as JSON and merged
+    """
+    def summary(self):
+        return {'count': self.count, 'mean': self.mean, 'm2': self.m2, 'sd': self.sd(),
+                'incomplete': self.incomplete, 'bins': BINS, 'histogram': self.histogram}
+
+    """
+    Rebuilds a report, without a results file, from its summary()
+    """
+    @staticmethod
+    def fromSummary(summary):
+        reporter = Reporter()
+        reporter.count = summary['count']
+        reporter.mean = summary['mean']
+        reporter.m2 = summary['m2']
+        reporter.incomplete = summary['incomplete']
+        reporter.histogram = list(summary['histogram'])
+        return reporter
+
+    """
+    Draws the confidence histogram to an image file
+
+    Parameters
+    ----------
+    path: (string) file destination of the image (e.g., 'confidence.png')
+    """
+    def render(self, path):
+        import matplotlib
+        matplotlib.use('Agg')  # Draws without a display
+        import matplotlib.pyplot as plt
+        fig = plt.figure(figsize=(10, 5))
+        plt.xlim((0, 100))
+        plt.bar(BINS[:-1], self.histogram, width=BINS[1] - BINS[0], align='edge',
+                facecolor='#2ab0ff', edgecolor='#169acf')
+        plt.xlabel('Confidence %')
+        plt.ylabel('Number of Observations')
+        plt.title(f'Histogram of {self.count} Transcript Confidence Readings')
+        fig.savefig(path)
+        plt.close(fig)
+
+    """
+    Closes the results file and the sink. The summary is saved next to the results file
+    """
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+            with open(self.path + '.summary.json', 'w') as fp:
+                json.dump(self.summary(), fp, indent=4)
+        if self.sink is not None:
+            self.sink.close()
+
+    """
+    Counts the forms of an existing results file. A line cut short by a killed run is skipped,
+    and ended so that the next form starts on its own line
+    """
+    def __resume__(self, path):
+        try:
+            fp = open(path, 'rb')
+        except FileNotFoundError:
+            return
+        with fp:
+            last = b'\n'
+            for line in fp:
+                last = line
+                try:
+                    self.__count__(json.loads(line))
+                except ValueError:
+                    continue
+        if not last.endswith(b'\n'):
+            with open(path, 'a') as fp:
+                fp.write('\n')
+
+    """
+    Finds the histogram bin of a confidence. Like np.histogram, the last bin includes 100
+    """
+    def __bin__(self, confidence):
+        step = BINS[1] - BINS[0]
+        return min(max(int(confidence // step), 0), len(BINS) - 2)
+
+"""
+Combines the summaries of several partial reports (e.g., one per worker or per run)
+
+Parameters
+----------
+paths: (list) file destinations of the .summary.json files saved by Reporter.close()
+
+Returns
+-------
+reporter: (Reporter) a report with the statistics of all of them
+"""
+def mergeReports(paths):
+    reporter = Reporter()
+    for path in paths:
+        with open(path) as fp:
+            reporter.merge(json.load(fp))
+    return reporter
@@ -1,18 +1,57 @@
-import spacy
-from dateutil import parser
+from datetime import date
+from AliasMatcher import AliasMatcher
+from DateNormalizer import RANGE, findDates
+from EntityDetector import getTypes
+from NERModel import getCache
+
+PARSERS = ('name', 'year')  # The kinds of metadata (see EntityDetector.TYPES) found in raw text
+
+"""
+Lists the missing fields that Phase 2 can look for in raw text
+
+Parameters
+----------
+form: (dictionary) a form as returned by EntityDetector(...).detectEntityKV(...)
+
+META: (dictionary) meta.data as loaded by loadData(...)
+
+Returns
+-------
+NA: (list) the names of the fields left as 'NA' whose metadata type can be found in raw text
+"""
+def getMissing(form, META):
+    return [field for spec in getTypes(META).values() if spec['parse'] in PARSERS
+            for field in spec['fields'] if form.get(field, 'NA') == 'NA']
+
+"""
+Tells whether detectEntity(...) will need the named entities of the lines
+
+Parameters
+----------
+NA: (list) the names of the missing fields
+
+META: (dictionary) meta.data as loaded by loadData(...)
+
+Returns
+-------
+needed: (boolean) True if a name is missing. Dates are found without NER
+"""
+def needsEntities(NA, META):
+    return any(spec['parse'] == 'name' and spec['fields'][0] in NA for spec in getTypes(META).values())
 
 """
 Handles analysis of transcript key-value pairs
 """
 class RawEntDetector():
-    nlp = spacy.load('en_core_web_trf')  # NLP Class Variable
 
     def __init__(self, META):
         self.META = META
+        self.cache = getCache()  # Shared model and entities of previously seen text
+        self.matcher = META.get('matcher') or AliasMatcher(META)  # loadData builds one matcher for every detector
         self.form = {}
     
     """
-    Extracts the first name, last name, and graduation year if the information is found in a transcript
+    Extracts the missing metadata of every type in meta.data that can be found in raw text
     
     Parameters
     ----------
@@ -20,6 +59,10 @@ class RawEntDetector():
                (e.g., 'GRAD')
    
     text: (list) a collection of strings representing text lines found in a document
+
+    entities: (dictionary) maps every line in text to the (text, label) entities spacy found
+                           in it. If not given and a name is missing, NER is run here as one batch.
+                           Dates do not need it
     
     Returns
     -------
@@ -27,14 +70,16 @@ class RawEntDetector():
                        desired metadata are the keys and the selected information from fields in
                        a transcript are the values (e.g. what the first name is)
     """
-    def detectEntity(self, NA, text):
-        if 'First' in NA:
-            first, last = self.__getName__(text)
-            self.form.update({'First': first,
-                             'Last': last})
-
-        # elif 'Grad' in NA:
-        #     grad = self.__getGrad__(text)
+    def detectEntity(self, NA, text, entities=None):
+        for name, spec in getTypes(self.META).items():
+            if spec['fields'][0] not in NA:
+                continue
+            if spec['parse'] == 'name':
+                if entities is None:
+                    entities = dict(zip(text, self.cache.pipe(text)))
+                self.form.update(zip(spec['fields'], self.__getName__(text, entities, spec['entity'])))
+            elif spec['parse'] == 'year':
+                self.form[spec['fields'][0]] = self.__getYear__(text, name, spec.get('ranges', False))
 
         return self.form
     
@@ -45,6 +90,10 @@ class RawEntDetector():
     Parameters
     ----------   
     text: (list) a collection of strings representing text lines found in a document
+
+    entities: (dictionary) maps every line in text to the (text, label) entities spacy found in it
+
+    label: (string) the entity label of a name
     
     Returns
     -------
@@ -57,13 +106,12 @@ class RawEntDetector():
     This algorithm needs improvements as it gets confused when there is a middle name.
     Likely can be optimized with more concise code
     """
-    def __getName__(self, text):
+    def __getName__(self, text, entities, label='PERSON'):
         names = []
 
         for line in text:
-            doc = self.nlp(line)
-            for ent in doc.ents:
-                if ent.label_ == 'PERSON':
+            for ent, found in entities[line]:
+                if found == label:
                     names.append(line)
 
         if len(names) == 1:
@@ -84,3 +132,51 @@ class RawEntDetector():
             first = 'NA'
             last = 'NA'
         return first, last
+
+    """
+    Finds the year of a metadata type (e.g., the graduation year) in the text lines of a
+    transcript with one pass over the lines and no NER. Every date is labelled by the text
+    written before it on its line, or by the line above when the date starts its line (e.g.,
+    'Graduation Date:' above '06/01/2018'). Labels are read with the "raw" aliases of meta.data,
+    which only match at the start of a word. A date whose label has an antialias of the type
+    (e.g., 'Date of Birth' or 'Date Issued' for Grad) is dropped. The others are ranked by how many aliases of the
+    type their label has, then ranges (e.g., '2014 - 2018', whose end year is taken) over single
+    dates, then the earliest line
+
+    Parameters
+    ----------
+    text: (list) a collection of strings representing text lines found in a document
+
+    name: (string) the metadata type in meta.data (e.g., 'Grad')
+
+    ranges: (boolean) if True, a range counts even when its label has no alias, as the end of
+                      enrollment does for Grad
+
+    Returns
+    -------
+    year: (string) the four digit year, or 'NA' if no date has an alias (or is a range)
+    """
+    def __getYear__(self, text, name, ranges=False):
+        latest = date.today().year + 10  # Later 'years' are more likely course or ID numbers
+        best, rank = 'NA', None
+        previous = ''
+        for position, line in enumerate(text):
+            end = 0
+            for start, stop, year in findDates(line):
+                label = line[end:start]
+                if end == 0 and label.strip(' :') == '':
+                    label = previous
+                end = stop
+                if not 1900 <= int(year) <= latest:
+                    continue
+                hits = self.matcher.count(label.lower(), 'raw')[name]
+                if hits['antialias'] > 0:
+                    continue
+                is_range = RANGE.fullmatch(line[start:stop]) is not None
+                if hits['alias'] == 0 and not (ranges and is_range):
+                    continue
+                candidate = (hits['alias'], is_range, -position)
+                if rank is None or candidate > rank:
+                    best, rank = year, candidate
+            previous = line
+        return best
@@ -0,0 +1,274 @@
+import json
+import mmap
+import os
+import sqlite3
+from FormWriter import FormWriter
+from Metrics import metrics
+from TextractStream import loadResponse
+S3_CLIENTS = {}  # One pooled S3 client per process
+
+"""
+The storage layer of the extraction pipeline. A source lists the transcripts and reads their
+Textract output, and a sink stores the extracted forms. lambda_handler(...) reads from an
+S3Source and writes to a DynamoSink by default. A LocalSource and a JSONLSink or SQLiteSink
+run the same pipeline over Textract output already on disk with no AWS access at all, which
+is what bulk reprocessing and benchmarks should use. boto3 is only imported once an AWS
+backend is used.
+
+Every source has
+    list() -> {folder: {file name: ETag}}
+    response(folder, name) -> the Textract output with 'Blocks' as a BlockIndex
+and must be picklable so that parallelMain(...) can hand it to worker processes. Every sink
+has add(form) and close(), works as a context manager and calls stored(ARN) once a form is
+safely stored (see Checkpoint).
+"""
+
+"""
+Gets the S3 client of this process, creating it the first time. The client keeps a pool of
+connections that every download, including the prefetch threads, reuses
+
+Returns
+-------
+s3: (client) a boto3 S3 client
+"""
+def getS3():
+    pid = os.getpid()
+    if pid not in S3_CLIENTS:
+        import boto3
+        from botocore.config import Config
+        S3_CLIENTS[pid] = boto3.client('s3', region_name='us-east-2', config=Config(max_pool_connections=32))
+    return S3_CLIENTS[pid]
+
+"""
+Textract output stored in an S3 bucket as <folder>/kv.json and <folder>/raw.json
+
+Parameters
+----------
+bucket: (string) the string name of the S3 bucket on an AWS account
+"""
+class S3Source():
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    """
+    Lists the transcript folders of the bucket, page by page
+
+    Returns
+    -------
+    files: (dictionary) key is a folder name and is mapped to the ETag of every file in it
+    """
+    def list(self):
+        files = {}
+        kwargs = {'Bucket': self.bucket}
+        while True:
+            response = getS3().list_objects_v2(**kwargs)
+            for object in response.get('Contents', []):
+                partitioned = object['Key'].split('/')  # Partitioned out file directory
+                desired = '/'.join(partitioned[0:-1])  # Directory specification
+                files.setdefault(desired, {})[partitioned[-1]] = object['ETag']
+            if not response.get('IsTruncated'):
+                break
+            kwargs['ContinuationToken'] = response['NextContinuationToken']
+        return files
+
+    """
+    Retrieves one Textract output file of a transcript, streaming it from S3
+
+    Parameters
+    ----------
+    folder: (string) the folder name that is named after a given transcript PDF. Ends with .pdf
+
+    name: (string) 'kv.json' or 'raw.json'
+
+    Returns
+    -------
+    response: (dictionary) the Textract output, with its blocks streamed into a BlockIndex
+                           stored under 'Blocks'
+    """
+    def response(self, folder, name):
+        with metrics.span('download', folder):
+            body = getS3().get_object(Bucket=self.bucket, Key=f'{folder}/{name}')['Body']
+        with metrics.span('parse', folder):
+            return loadResponse(body)
+
+"""
+Textract output stored on local disk as <directory>/<folder>/kv.json and raw.json, e.g. a
+copy of the bucket made with 'aws s3 sync'. Files are memory mapped, so they are parsed
+straight from the page cache without being copied into Python first
+
+Parameters
+----------
+directory: (string) the local folder holding the transcript folders
+"""
+class LocalSource():
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    """
+    Lists the transcript folders under the directory. A file's size and modification time
+    stand in for its ETag, so a checkpoint notices files that were replaced
+
+    Returns
+    -------
+    files: (dictionary) key is a folder name and is mapped to the ETag of every file in it
+    """
+    def list(self):
+        files = {}
+        for root, dirs, names in os.walk(self.directory):
+            dirs.sort()
+            if 'kv.json' not in names:
+                continue
+            folder = os.path.relpath(root, self.directory).replace(os.sep, '/')
+            files[folder] = {}
+            for name in ('kv.json', 'raw.json'):
+                if name in names:
+                    stat = os.stat(os.path.join(root, name))
+                    files[folder][name] = f'{stat.st_size}-{stat.st_mtime_ns}'
+        return files
+
+    """
+    Retrieves one Textract output file of a transcript from disk
+
+    Parameters
+    ----------
+    folder: (string) the folder name that is named after a given transcript PDF
+
+    name: (string) 'kv.json' or 'raw.json'
+
+    Returns
+    -------
+    response: (dictionary) the Textract output, with its blocks parsed into a BlockIndex
+                           stored under 'Blocks'
+    """
+    def response(self, folder, name):
+        with metrics.span('parse', folder), open(os.path.join(self.directory, folder, name), 'rb') as fp:
+            if os.fstat(fp.fileno()).st_size == 0:
+                return loadResponse(fp)  # Empty files cannot be memory mapped
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as body:
+                return loadResponse(body, chunk_size=1 << 20)
+
+"""
+Stores forms in a DynamoDB table through a buffered FormWriter
+
+Parameters
+----------
+table: (string) the text representation of the name of the DynamoDB table
+
+flush_interval: (float) the most seconds a form waits before it is written (see FormWriter)
+
+stored: (function) if given, called with the ARN of every form once DynamoDB has accepted it
+
+db: (client) a boto3 DynamoDB client. Created if not given
+"""
+class DynamoSink(FormWriter):
+
+    def __init__(self, table='Final251', flush_interval=5.0, stored=None, db=None):
+        if db is None:
+            import boto3
+            db = boto3.client('dynamodb', region_name='us-east-2')  # Initialize AWS database client
+        super().__init__(db, table, flush_interval, stored=stored)
+
+"""
+Appends forms to a local JSON Lines file, one form per line
+
+Parameters
+----------
+path: (string) file destination of the output. Forms are appended if it exists
+
+stored: (function) if given, called with the ARN of every form once its line is flushed
+"""
+class JSONLSink():
+
+    def __init__(self, path, stored=None):
+        self.stored = stored
+        self.fp = open(path, 'a')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    """
+    Writes a form
+
+    Parameters
+    ----------
+    form: (dictionary) a mapping of metadata names to extracted information, along with the
+                       'ARN' of the transcript the information came from
+    """
+    def add(self, form):
+        with metrics.span('db_write', form['ARN']):
+            self.fp.write(json.dumps(form) + '\n')
+            self.fp.flush()
+        if self.stored is not None:
+            self.stored(form['ARN'])
+
+    """
+    Closes the file
+    """
+    def close(self):
+        self.fp.close()
+
+"""
+Stores forms in a local SQLite database, in a table of (ARN, form) rows where form is the
+JSON of the extracted form. A transcript extracted again replaces its row. Rows are committed
+in groups so that the database is not synced to disk once per transcript
+
+Parameters
+----------
+path: (string) file destination of the database. Created if it does not exist
+
+stored: (function) if given, called with the ARN of every form once its row is committed
+
+commit_every: (int) the number of forms per transaction
+"""
+class SQLiteSink():
+
+    def __init__(self, path, stored=None, commit_every=100):
+        self.stored = stored
+        self.commit_every = commit_every
+        self.pending = []
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS forms (ARN TEXT PRIMARY KEY, form TEXT)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    """
+    Writes a form, committing once commit_every forms are waiting
+
+    Parameters
+    ----------
+    form: (dictionary) a mapping of metadata names to extracted information, along with the
+                       'ARN' of the transcript the information came from
+    """
+    def add(self, form):
+        with metrics.span('db_write', form['ARN']):
+            self.db.execute('INSERT OR REPLACE INTO forms VALUES (?, ?)', (form['ARN'], json.dumps(form)))
+        self.pending.append(form['ARN'])
+        if len(self.pending) >= self.commit_every:
+            self.flush()
+
+    """
+    Commits the waiting forms
+    """
+    def flush(self):
+        with metrics.span('db_write'):
+            self.db.commit()
+        if self.stored is not None:
+            for arn in self.pending:
+                self.stored(arn)
+        self.pending = []
+
+    """
+    Commits the waiting forms and closes the database
+    """
+    def close(self):
+        self.flush()
+        self.db.close()
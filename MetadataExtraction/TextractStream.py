@@ -0,0 +1,134 @@
+import codecs
+import json
+from BlockIndex import BlockIndex
+
+"""
+Parses a Textract response (kv.json or raw.json) straight from a stream such as an S3 body.
+The 'Blocks' array is decoded one block at a time and each block goes directly into a
+BlockIndex, so the full document tree (Polygon geometry, per-word metadata, ...) is never
+held in memory. Only one block and one chunk of the file are decoded at any moment.
+"""
+decoder = json.JSONDecoder()
+WHITESPACE = ' \t\n\r'
+
+"""
+Reads a Textract response from a stream
+
+Parameters
+----------
+body: (file-like) anything with read(size) that returns bytes or str (e.g., the 'Body' of an
+                  S3 get_object response, an open file or a memory map)
+
+chunk_size: (int) the number of bytes read from the stream at a time
+
+Returns
+-------
+response: (dictionary) the top-level fields of the response ('DocumentMetadata', 'JobStatus',
+                       etc.), except that 'Blocks' maps to the BlockIndex of the blocks
+"""
+def loadResponse(body, chunk_size=1 << 16):
+    reader = __Reader__(body, chunk_size)
+    response = {'Blocks': BlockIndex()}
+
+    reader.expect('{')
+    if reader.peek() == '}':
+        reader.take()
+        return response
+    while True:
+        key = reader.value()
+        reader.expect(':')
+        if key == 'Blocks':
+            reader.expect('[')
+            if reader.peek() == ']':
+                reader.take()
+            else:
+                while True:
+                    response['Blocks'].add(reader.value())
+                    if reader.take() == ']':
+                        break
+        else:
+            response[key] = reader.value()
+        if reader.take() == '}':
+            break
+
+    return response
+
+"""
+A buffer over the stream that only ever holds the part of the file not yet decoded
+"""
+class __Reader__():
+
+    def __init__(self, body, chunk_size):
+        self.body = body
+        self.chunk_size = chunk_size
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    """
+    Returns the next character that is not whitespace without consuming it
+    """
+    def peek(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self.__fill__():
+                break
+        if self.pos >= len(self.buffer):
+            raise ValueError('Unexpected end of Textract response')
+        return self.buffer[self.pos]
+
+    """
+    Consumes and returns the next character that is not whitespace
+    """
+    def take(self):
+        char = self.peek()
+        self.pos += 1
+        return char
+
+    """
+    Consumes the next character that is not whitespace, which must be the one given
+    """
+    def expect(self, char):
+        found = self.take()
+        if found != char:
+            raise ValueError(f'Expected {char!r} in Textract response, found {found!r}')
+
+    """
+    Decodes the next JSON value, reading more of the stream until the value is complete. A
+    value that ends exactly at the end of the buffer could be a number cut in half, so it is
+    only accepted once the stream is exhausted or more text follows it
+    """
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.pos)
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.__fill__()
+
+    """
+    Drops the decoded part of the buffer and appends the next chunk of the stream
+
+    Returns
+    -------
+    filled: (boolean) False if the stream has no more data
+    """
+    def __fill__(self):
+        if self.eof:
+            return False
+        chunk = self.body.read(self.chunk_size)
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+        if not chunk:
+            self.eof = True
+            self.buffer += self.utf8.decode(b'', final=True)
+            return False
+        self.buffer += self.utf8.decode(chunk) if isinstance(chunk, bytes) else chunk
+        return True
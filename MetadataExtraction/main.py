@@ -1,41 +1,58 @@
 import json
-import boto3
+import logging
+import os
+import signal
+import sys
 import urllib.parse
-# python -m spacy download en_core_web_trf
-import spacy
 import time
-from EntityDetector import EntityDetector
-from RawEntDetector import RawEntDetector
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import partial
+from AliasMatcher import AliasMatcher
+from Artifact import Pairs, Lines, writeArtifact, loadArtifact
+from BlockIndex import BlockIndex
+from Checkpoint import Checkpoint
+from EntityDetector import EntityDetector, getFields, getTypes
+from LineIndex import LineIndex
+from Metrics import log, metrics
+from RawEntDetector import RawEntDetector, getMissing, needsEntities
+from Storage import S3Source, LocalSource, DynamoSink, JSONLSink, SQLiteSink
+from NERModel import LocalModel, getCache, getModel
+from NERScheduler import NERScheduler
 import ProgressReport as pr
+
 """
-Retrieves key-value pair and raw text OCR extraction from JSON files in an S3 bucket.
+Downloads the key-value pair output of upcoming transcripts on background threads while the
+current transcript is being extracted. The raw text output is not downloaded. Instead each
+transcript comes with a function that fetches it, which main(...) only calls if Phase 2 runs
 
 Parameters
 ----------
-bucket: (string) the string name of the S3 bucket on an AWS account
-folder: (string) the folder name that is named after a given transcript PDF. Ends with .pdf
+source: (S3Source or LocalSource) where the Textract output is read from (see Storage.py)
+
+folders: (iterable) the folder names of the transcripts, in the order they will be extracted
+
+depth: (int) how many transcripts are downloaded ahead of the current one
 
 Returns
 -------
-kv_json: (dictionary) unaltered output from Textract's get_document_analysis(...) API
-                      and contains OCR extraction information on key-value pairs
-raw_json: (dictionary) unaltered output from Textract's get_document_text_detection(...)
-                       API and contains OCR extraction information on text blocks
+documents: (generator) a (folder, kv_json, raw_json) tuple per transcript, where raw_json is a
+                       function that returns the raw text output when called
 """
-def getFileContent(bucket, folder):
-    s3res = boto3.resource('s3', region_name='us-east-2')
-    kvObj = s3res.Object(bucket, f'{folder}/kv.json')
-    rawObj = s3res.Object(bucket, f'{folder}/raw.json')
-
-    # Retrieve the key-value pair contents
-    kv_content = kvObj.get()['Body'].read().decode('utf-8')
-    kv_json = json.loads(kv_content)
-
-    # Retrieve the raw text contents
-    raw_content = rawObj.get()['Body'].read().decode('utf-8')
-    raw_json = json.loads(raw_content)
-
-    return kv_json, raw_json
+def prefetch(source, folders, depth=4):
+    folders = iter(folders)
+    with ThreadPoolExecutor(max_workers=depth) as pool:
+        pending = deque()
+        for k in folders:
+            pending.append((k, pool.submit(source.response, k, 'kv.json')))
+            if len(pending) == depth:
+                break
+        while pending:
+            k, future = pending.popleft()
+            for upcoming in folders:
+                pending.append((upcoming, pool.submit(source.response, upcoming, 'kv.json')))
+                break
+            yield k, future.result(), partial(source.response, k, 'raw.json')
 
 """
 Takes OCR results from the key-value pairs and raw text of a document, extracts the
@@ -44,135 +61,335 @@ alongiside the ARN--into DynamoDB on AWS.
 
 Priotity work to be done: algorithm to get school name from folder naming conventions 
 and full ARN (instead of the current transcript file name).
+
+Parameters
+----------
+bucket: (string) the string name of the S3 bucket on an AWS account. May be None if a source
+                  is given
+
+batch_docs: (int) if given, transcripts are processed in groups of this many documents with
+                  their NER batched together (see batchMain). Otherwise one at a time
+
+batch_size: (int) the number of strings the transformer processes at a time in batch mode
+
+n_process: (int) the number of processes spacy spreads each batch over in batch mode
+
+workers: (int) if given, transcripts are spread over a pool of this many processes (see
+               parallelMain)
+
+task_timeout: (float) seconds a single transcript may take in the parallel mode
+
+flush_interval: (float) the most seconds an extracted form waits before it is written to
+                        DynamoDB (see FormWriter)
+
+source: (S3Source or LocalSource) where the Textract output is read from. Defaults to the
+                                    S3 bucket (see Storage.py)
+
+sink: (DynamoSink, JSONLSink or SQLiteSink) where the extracted forms are stored. Defaults to
+                                           the Final251 DynamoDB table
+
+checkpoint: (string) file destination of the run's manifest (see Checkpoint). Transcripts
+                     already extracted from the same kv.json, raw.json and meta.data are
+                     skipped. Defaults to the CHECKPOINT_PATH environment variable (e.g., a
+                     file on an EFS mount), and everything is extracted if neither is set
+
+report: (string) if given, file destination of a JSON Lines extraction report that is built
+                 while forms are produced, with its confidence statistics saved next to it
+                 (see ProgressReport.Reporter)
 """
-def lambda_handler(bucket):
-    db = boto3.client('dynamodb', region_name='us-east-2')  # Initialize AWS database client
-    s3 = boto3.client('s3', region_name='us-east-2')
+def lambda_handler(bucket, batch_docs=None, batch_size=64, n_process=1, workers=None, task_timeout=None,
+                   flush_interval=5.0, source=None, sink=None, checkpoint=None, report=None):
+    if checkpoint is None:
+        checkpoint = os.environ.get('CHECKPOINT_PATH')  # Read per call, as warm containers are reused
+    if source is None:
+        source = S3Source(bucket)
+    if sink is None:
+        sink = DynamoSink(flush_interval=flush_interval)
+    if report is not None:
+        sink = pr.Reporter(report, sink)
 
     META = loadData('meta.data')
 
-    objects = s3.list_objects(Bucket=bucket)['Contents']
-    files = {}
-    for object in objects:
-        partitioned = object['Key'].split('/')  # Partitioned out file directory
-        desired = '/'.join(partitioned[0:-1])  # Directory specification
-        if not desired in files.keys():
-            files[desired] = {}
+    files = source.list()  # Folder name -> ETag of each of its files
+
+    if checkpoint is not None:
+        checkpoint = Checkpoint(checkpoint, META)
+        sink.stored = lambda k: checkpoint.record(k, files[k])
+        folders = [k for k in files.keys() if not checkpoint.done(k, files[k])]
+        log.info(f'Skipping {len(files) - len(folders)} transcripts already extracted')
+    else:
+        folders = list(files.keys())
+
+    try:
+        with sink as writer:
+            return extractAll(source, folders, META, writer, batch_docs, batch_size, n_process, workers,
+                              task_timeout)
+    finally:
+        metrics.flush()
+        if checkpoint is not None:
+            checkpoint.close()
+
+"""
+Extracts the metadata of transcripts in the mode lambda_handler(...) was called with
+
+Parameters
+----------
+source: (S3Source or LocalSource) where the Textract output is read from
+
+folders: (list) the folder names of the transcripts to extract
+
+META: (dictionary) a mapping of different of key words (aliases) and words that indicate wrong
+                   selection (antialiases) to our desired metadata
+
+writer: (DynamoSink, JSONLSink or SQLiteSink) stores the extracted forms
+
+batch_docs, batch_size, n_process, workers, task_timeout: see lambda_handler(...)
+
+Returns
+-------
+output: (list) the extracted form of every transcript
+"""
+def extractAll(source, folders, META, writer, batch_docs=None, batch_size=64, n_process=1, workers=None,
+               task_timeout=None):
+    if workers is not None:
+        return parallelMain(source, folders, writer, workers, task_timeout)
+    if batch_docs is not None:
+        return batchHandler(source, folders, META, writer, batch_docs, batch_size, n_process)
 
     output = []
-    for k in files.keys():
-        kv_json, raw_json = getFileContent(bucket, k)
-        files[k]['kv'] = kv_json
-        files[k]['raw'] = raw_json
-        print(k)
+    for k, kv_json, raw_json in prefetch(source, folders):
+        log.debug(k)
 
-        form = main(kv_json, raw_json, META)
+        with metrics.document(k):
+            form = main(kv_json, raw_json, META)
         form['ARN'] = k
-        print(form)
-
-        # Store the information in proper format for DB
-        db_items = {
-            'First': {'S': form['First']},
-            'Last': {'S': form['Last']},
-            'Grad': {'S': form['Grad']},
-            'ARN': {'S': form['ARN']}
-        }
+        log.debug(form)
         output.append(form)
+        writer.add(form)
+        metrics.flush()  # Spans are written as they come rather than held until the run ends
+    return output
+
+"""
+Extracts the metadata of transcripts in groups of documents whose NER is batched together
+(see batchMain), downloading the next group while the current one is extracted
+
+Parameters
+----------
+source: (S3Source or LocalSource) where the Textract output is read from
+
+folders: (list) the folder names of the transcripts to extract
+
+META: (dictionary) a mapping of different of key words (aliases) and words that indicate wrong
+                   selection (antialiases) to our desired metadata
+
+writer: (DynamoSink, JSONLSink or SQLiteSink) stores the extracted forms
+
+batch_docs: (int) the number of transcripts per group
 
-        # Put an item in the database
-        data = db.put_item(
-            TableName='Final251',
-            Item=db_items
-        )
+batch_size: (int) the number of strings the transformer processes at a time
 
+n_process: (int) the number of processes spacy spreads each batch over
+
+Returns
+-------
+output: (list) the extracted form of every transcript
+"""
+def batchHandler(source, folders, META, writer, batch_docs, batch_size=64, n_process=1):
+    output = []
+    downloads = prefetch(source, folders, depth=batch_docs)
+    for i in range(0, len(folders), batch_docs):
+        documents = {}
+        for _ in folders[i:i + batch_docs]:
+            k, kv_json, raw_json = next(downloads)
+            documents[k] = (kv_json, raw_json)
+
+        forms = batchMain(documents, META, batch_size, n_process)
+        for k, form in forms.items():
+            form['ARN'] = k
+            log.debug(form)
+            output.append(form)
+            writer.add(form)
+        metrics.flush()  # Once per group, so spans are not held until the run ends
+    return output
+
+"""
+Extracts the metadata of many transcripts on a pool of processes, one transcript per task.
+Each worker loads meta.data and the spacy model (or connects to NERService) once, and forms
+are stored as soon as any worker finishes them
+
+Parameters
+----------
+source: (S3Source or LocalSource) where the Textract output is read from
+
+folders: (list) the folder names of the transcripts to extract
+
+writer: (DynamoSink, JSONLSink or SQLiteSink) stores the extracted forms
+
+workers: (int) the number of worker processes, usually the number of cores
+
+timeout: (float) seconds a single transcript may take. Transcripts that take longer are
+                 reported as failed and their worker moves on to the next one
+
+Returns
+-------
+output: (list) the extracted form of every transcript that finished, in completion order
+"""
+def parallelMain(source, folders, writer, workers=os.cpu_count(), timeout=None):
+    output = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=initWorker, initargs=('meta.data',)) as pool:
+        futures = {pool.submit(extractFolder, source, k, timeout): k for k in folders}
+        for future in as_completed(futures):
+            try:
+                form = future.result()
+            except Exception as e:
+                log.error(f'Extraction failed for {futures[future]}: {e!r}')
+                continue
+            log.debug(form)
+            output.append(form)
+            writer.add(form)
+    return output
+
+WORKER_META = None  # meta.data of a parallelMain worker process, loaded by initWorker
+
+"""
+Prepares a worker process of parallelMain. Inference is limited to one thread per worker so
+that the workers do not compete for the same cores
+
+Parameters
+----------
+file: (string) file destination of meta.data
+"""
+def initWorker(file):
+    global WORKER_META
+    os.environ.setdefault('OMP_NUM_THREADS', '1')
+    WORKER_META = loadData(file)
+    metrics.reset()
+    getCache()  # Shared by every transcript of this worker
+    model = getModel()
+    if isinstance(model, LocalModel):
+        model.load()  # Here rather than inside the first transcript's task_timeout
+
+"""
+Extracts the metadata of one transcript inside a worker process of parallelMain
+
+Parameters
+----------
+source: (S3Source or LocalSource) where the Textract output is read from
+
+folder: (string) the folder name that is named after a given transcript PDF
+
+timeout: (float) if given, the extraction is interrupted with a TimeoutError after this many
+                 seconds
+
+Returns
+-------
+form: (dictionary) the extracted metadata of the transcript, along with its 'ARN'
+"""
+def extractFolder(source, folder, timeout=None):
+    def expire(signum, frame):
+        raise TimeoutError(f'{folder} took longer than {timeout} seconds')
+
+    if timeout is not None:
+        signal.signal(signal.SIGALRM, expire)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        with metrics.document(folder):
+            kv_json = source.response(folder, 'kv.json')
+            raw_json = partial(source.response, folder, 'raw.json')  # Only fetched if Phase 2 runs
+            form = main(kv_json, raw_json, WORKER_META)
+    finally:
+        if timeout is not None:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        metrics.flush()  # Workers are killed without running atexit
+
+    form['ARN'] = folder
+    return form
+
+"""
+Builds the block index of a Textract response, unless it already is one
+
+Parameters
+----------
+tokens: (list or BlockIndex) the 'Blocks' of a Textract response, or their BlockIndex
+
+Returns
+-------
+index: (BlockIndex) the compact index every extraction stage reads from
+"""
+def toIndex(tokens):
+    if isinstance(tokens, BlockIndex):
+        return tokens
+    with metrics.span('index'):
+        return BlockIndex(tokens)
 
 """
 Takes in raw output from get_document_analysis(...)
-and sorts through data to return a mapping for all blocks
-through their respective ID and a list for all key blocks
-through their respective ID, and the average confidence of
-OCR extraction
+and sorts through data to return the block index, a list
+for all key blocks through their respective row, and the
+average confidence of OCR extraction
 
 Parameters
 ----------
-tokens: (list) each element is a dictionary that represents a single block of information
-               identified from the OCR extraction ('Id', 'EntityType', 'BlockType', 'Text',
-               'Relationships', 'Confidence', etc.)
+tokens: (list or BlockIndex) each element is a dictionary that represents a single block of
+                             information identified from the OCR extraction ('Id', 'EntityType',
+                             'BlockType', 'Text', 'Relationships', 'Confidence', etc.)
 
 Returns
 -------
-token_map: (dictionary) a mapping such that keys are the Id's of blocks found from OCR and
-                        the values are the same dictionaries stores in the list tokens
+index: (BlockIndex) a compact index of every block found from OCR, addressed by row
                         
-key_ids: (list) contains all blocks that are identified such that 'BlockType' == 'KEY_VALUE_SET'
+key_ids: (array) the rows of all blocks that are identified such that 'BlockType' == 'KEY_VALUE_SET'
          and 'EntityType' == 'KEY'. Allows to find value and text information from this
          parent block
                          
 confidence: (float) represents the average confidence of OCR readings from every block found
 """
 def extractIds(tokens):
-    token_map = {}
-    key_ids = []
-    conf_list = []
-    for token in tokens:
-        token_id = token['Id']
-        token_map[token_id] = token
-        if 'Confidence' in token:
-            conf_list.append(token['Confidence'])
-        if token['BlockType'] == 'KEY_VALUE_SET' and 'KEY' in token['EntityTypes']:
-            key_ids.append(token_id)
-    confidence = sum(conf_list) / len(tokens)
-    return token_map, key_ids, confidence
-
-"""
-Finds all value block ids for a given key block id
+    index = toIndex(tokens)
+    return index, index.key_rows, index.averageConfidence()
+
+"""
+Finds all value block rows for a given key block row
 
 Parameters
 ----------
-token: (dictionary) represents a single block of information identified from the OCR 
-                    extraction ('Id', 'EntityType', 'BlockType', 'Text', 'Relationships',
-                    'Confidence', etc.)
+row: (int) the row of a key block in the index
+
+index: (BlockIndex) a compact index of every block found from OCR, addressed by row
 
 Returns
 -------                   
-value_ids: (list) contains all block ids that are identified such that 'BlockType' == 'KEY_VALUE_SET'
-                  and 'EntityType' == 'VALUE' specifically as a descendent from a key block
+value_ids: (array) the rows of all blocks that are identified such that 'BlockType' == 'KEY_VALUE_SET'
+                   and 'EntityType' == 'VALUE' specifically as a descendent from a key block
 """
-def getValueIds(token):
-    for relation in token['Relationships']:
-        if relation['Type'] == 'VALUE':
-            value_ids = relation['Ids']
-    return value_ids
+def getValueIds(row, index):
+    value_ids = index.values[row]
+    return value_ids if value_ids is not None else ()
 
 """
 By inputting a block, this function will extract the text that pertains to it.
 
 Parameters
 ----------
-token: (dictionary) represents a single block of information identified from the OCR 
-                    extraction ('Id', 'EntityType', 'BlockType', 'Text', 'Relationships',
-                    'Confidence', etc.)
+row: (int) the row of a block in the index
 
-token_map: (dictionary) a mapping such that keys are the Id's of blocks found from OCR and
-                        the values are the same dictionaries stores in the list tokens
+index: (BlockIndex) a compact index of every block found from OCR, addressed by row
                         
 Returns
 -------                   
 phrase: (string) the text extracted from either a key or value block
 """
-def getText(token, token_map):
+def getText(row, index):
     words = []
-    if 'Relationships' in token:
-        for relationship in token['Relationships']:
-            if relationship['Type'] == 'CHILD':
-                for child_id in relationship['Ids']:
-                    if child_id in token_map.keys():
-                        word = token_map[child_id]
-                        if word['BlockType'] == 'WORD':
-                            words.append(word['Text'])
-                        elif word['BlockType'] == 'SELECTION_ELEMENT':
-                            if word['SelectionStatus'] == 'SELECTED':
-                                words.append('X')
+    children = index.children[row]
+    if children is not None:
+        for child in children:
+            block_type = index.types[child]
+            if block_type == BlockIndex.WORD:
+                words.append(index.text[child])
+            elif block_type == BlockIndex.SELECTION_ELEMENT:
+                if index.selected[child]:
+                    words.append('X')
     phrase = ' '.join(words)
     return phrase
 
@@ -181,48 +398,104 @@ Phase 1. Extract the key-value pairs from a transcript and use it to identify me
 
 Parameters
 ----------
-tokens: (list) each element is a dictionary that represents a single block of information
-               identified from the OCR extraction ('Id', 'EntityType', 'BlockType', 'Text',
-               'Relationships', 'Confidence', etc.)
+tokens: (list or BlockIndex) each element is a dictionary that represents a single block of
+                             information identified from the OCR extraction ('Id', 'EntityType',
+                             'BlockType', 'Text', 'Relationships', 'Confidence', etc.)
                
 META: (dictionary) a mapping of different of key words (aliases) and words that indicate wrong 
                    selection (antialiases) to our desired metadata (first, last, and graduation 
                    date). Currently there only exists aliases and antaliases for key blocks of
                    the metadata
 
+entities: (dictionary) maps the strings EntityDetector(...).getValues(...) lists for this document
+                       to their spacy entities. If not given, NER is run on this document alone
+
 Returns
 -------
 form: (dictionary) a mapping of metadata names to extracted information. In other words, the
                    desired metadata are the keys and the selected information from fields in
                    a transcript are the values (e.g. what the first name is)
 """
-def getKeyValues(tokens, META):
-    # Gets the mapping for IDs of blocks to the blocks themselves
-    token_map, key_ids, confidence = extractIds(tokens)
-
+def getKeyValues(tokens, META, entities=None):
     # Gets key-value mapping
-    mappings = getMapping(token_map, key_ids)
-
+    mappings, confidence = getKVMappings(tokens)
 
     # Initialize EntityDetector
     ed = EntityDetector(META)
 
     # Get the metadata
-    form = ed.detectEntityKV(mappings)
+    form = ed.detectEntityKV(mappings, entities)
+    log.debug(f'NER on {ed.ner_calls} values, {ed.ner_saved} skipped')
 
     # Report confidence of readings
     form['Confidence'] = confidence
 
     return form
 
+"""
+Gets the key-value pair mappings of a transcript straight from the OCR extraction
+
+Parameters
+----------
+tokens: (list or BlockIndex) each element is a dictionary that represents a single block of
+                             information identified from the OCR extraction ('Id', 'EntityType',
+                             'BlockType', 'Text', 'Relationships', 'Confidence', etc.)
+
+Returns
+-------
+mappings: (dictionary) key is the field name found in a document, and is mapped to another
+                       dictionary with 'Value' and 'Top' (see getMapping)
+
+confidence: (float) represents the average confidence of OCR readings from every block found
+"""
+def getKVMappings(tokens):
+    if isinstance(tokens, Pairs):  # Already resolved when the artifact was written
+        return tokens.mappings(), tokens.confidence
+
+    # Gets the index of every block and the rows of the key blocks
+    index, key_ids, confidence = extractIds(tokens)
+
+    # Gets key-value mapping
+    with metrics.span('mapping'):
+        mappings = getMapping(index, key_ids)
+
+    return mappings, confidence
+
+"""
+Extracts every line of text found in a transcript document along with where it is
+
+Parameters
+----------
+tokens: (list, BlockIndex or Lines) each element is a dictionary that represents a single block
+                                    of information identified from the OCR extraction, or the
+                                    lines already resolved in an artifact
+
+Returns
+-------
+lines: (list) a (text, top, left, page) tuple for every line, in the order Textract found them
+
+confidence: (float) represents the average confidence of OCR readings from every block found
+"""
+def getLines(tokens):
+    if isinstance(tokens, Lines):  # Already resolved when the artifact was written
+        return tokens.lines(), tokens.confidence
+
+    index = toIndex(tokens)
+    lines = []
+    for line_id in index.line_rows:
+        text = getText(line_id, index)
+        lines.append((text, index.top[line_id], index.left[line_id], index.page[line_id]))
+
+    return lines, index.averageConfidence()
+
 """
 Extracts all the lines of text found in a transcript document.
 
 Parameters
 ----------
-tokens: (list) each element is a dictionary that represents a single block of information
-               identified from the OCR extraction ('Id', 'EntityType', 'BlockType', 'Text',
-               'Relationships', 'Confidence', etc.)
+tokens: (list or BlockIndex) each element is a dictionary that represents a single block of
+                             information identified from the OCR extraction ('Id', 'EntityType',
+                             'BlockType', 'Text', 'Relationships', 'Confidence', etc.)
                         
 Returns
 -------                   
@@ -234,42 +507,71 @@ confidence: (float) represents the average confidence of OCR readings from every
 """
 def getRawText(tokens):
     words = {}
-    token_map = {}
-    line_ids = []
-    conf_list = []
-
-    for token in tokens:
-        token_id = token['Id']
-        token_map[token_id] = token
-        if 'Confidence' in token:
-            conf_list.append(token['Confidence'])
-        if token['BlockType'] == 'LINE':
-            line_ids.append(token['Id'])
-
-    for line_id in line_ids:
-        line = token_map[line_id]
-        text = getText(line, token_map)
-        y = line['Geometry']['BoundingBox']['Top']
-        x = line['Geometry']['BoundingBox']['Left']
+    lines, confidence = getLines(tokens)
+
+    for text, y, x, page in lines:
         #words[text] = {'x': x, 'y': y}
         words[text] = y
 
-    confidence = sum(conf_list) / len(tokens)
-
     return words, confidence
 
 def getLocation(token):
     pass
 
+DEFAULT_REGION = {'top': (0.0, 0.3)}  # Where Phase 2 looks for metadata without a region in meta.data
+
+"""
+Finds the lines of text Phase 2 reads for the missing metadata. Each metadata type can have its
+own region of the page in the 'regions' of meta.data, e.g.
+    "regions": {"Name": {"top": [0.0, 0.3]}, "Grad": {"top": [0.0, 0.3], "left": [0.5, 1.0]}}
+with optional 'left' bounds and 'pages' (see LineIndex.region). Types without one use the top
+30% of every page. The lines are indexed once from their positions, every region is a range
+query on the index, and only the lines of the regions have their text resolved
+
+Parameters
+----------
+tokens: (list, BlockIndex or Lines) the raw text blocks of a document
+
+NA: (list) the names of the missing metadata (e.g., 'First', 'Grad')
+
+META: (dictionary) meta.data as loaded by loadData(...)
+
+Returns
+-------
+text: (list) the distinct lines of every region, in the order Textract found them
+
+confidence: (float) represents the average confidence of OCR readings from every block found
+"""
+def getRegionLines(tokens, NA, META):
+    if isinstance(tokens, Lines):  # Positions straight from the artifact, text decoded on demand
+        index = LineIndex(tokens.top, tokens.left, tokens.page, tokens.text)
+        confidence = tokens.confidence
+    else:
+        blocks = toIndex(tokens)
+        index = LineIndex(blocks.top, blocks.left, blocks.page, lambda row: getText(row, blocks),
+                          blocks.line_rows)
+        confidence = blocks.averageConfidence()
+
+    regions = META.get('regions', {})
+    types = {field: name for name, spec in getTypes(META).items() for field in spec['fields']}
+    lines = set()
+    for name in dict.fromkeys(types.get(m, m) for m in NA):
+        region = regions.get(name, DEFAULT_REGION)
+        lines.update(index.region(tuple(region.get('top', (0.0, 1.0))),
+                                  tuple(region['left']) if 'left' in region else None,
+                                  region.get('pages')))
+
+    return index.text(sorted(lines)), confidence
+
 """
 Phase 2 extraction. If we cannot extract sufficient information from the Phase 1 extraction of key-value pairs,
 then we will move to extraction using raw text in hopes of finding the remaining information
 
 Parameters
 ----------
-tokens: (list) each element is a dictionary that represents a single block of information
-               identified from the OCR extraction ('Id', 'EntityType', 'BlockType', 'Text',
-               'Relationships', 'Confidence', etc.)
+tokens: (list or BlockIndex) each element is a dictionary that represents a single block of
+                             information identified from the OCR extraction ('Id', 'EntityType',
+                             'BlockType', 'Text', 'Relationships', 'Confidence', etc.)
                
 NA: (list) a collection of strings, where strings are the names of any piece of missing metadata
            (e.g., 'GRAD')
@@ -279,26 +581,21 @@ META: (dictionary) a mapping of different of key words (aliases) and words that
                    date). Currently there only exists aliases and antaliases for key blocks of
                    the metadata
 
+entities: (dictionary) maps the lines getRegionLines(...) finds in this document to their spacy
+                       entities. If not given, NER is run on this document alone
+
 Returns
 -------
 form: (dictionary) a mapping of metadata names to extracted information. In other words, the
                    desired metadata are the keys and the selected information from fields in
                    a transcript are the values (e.g. what the first name is)
 """
-def getRemainder(tokens, NA, META):
-    nlp = spacy.load('en_core_web_trf')
-    thirty_percent = []
-
-    text, confidence = getRawText(tokens)
-
-    for t in text:
-
-        if text[t] <= 0.3:
-            thirty_percent.append(t)
+def getRemainder(tokens, NA, META, entities=None):
+    text, confidence = getRegionLines(tokens, NA, META)
 
     red = RawEntDetector(META)  # Instantiating class
 
-    form = red.detectEntity(NA, thirty_percent)
+    form = red.detectEntity(NA, text, entities)
 
     form['Confidence'] = confidence
 
@@ -306,14 +603,13 @@ def getRemainder(tokens, NA, META):
 
 
 """
-Gets the key-value pair mappings and location from a structured token_map
+Gets the key-value pair mappings and location from the block index
 
 Parameters
 ----------
-token_map: (dictionary) a mapping such that keys are the Id's of blocks found from OCR and
-                        the values are the same dictionaries stores in the list tokens
+index: (BlockIndex) a compact index of every block found from OCR, addressed by row
                         
-key_ids: (list) contains all blocks that are identified such that 'BlockType' == 'KEY_VALUE_SET'
+key_ids: (array) the rows of all blocks that are identified such that 'BlockType' == 'KEY_VALUE_SET'
          and 'EntityType' == 'KEY'. Allows to find value and text information from this
          parent block
 
@@ -325,26 +621,24 @@ mappings: (dictionary) key is the field name found in a document, and is mapped
                        the relative percentage distance this key-value pair was from the top
                        of the document
 """
-def getMapping(token_map, key_ids):
+def getMapping(index, key_ids):
     mappings = {}
     for key_id in key_ids:
-        if key_id in token_map.keys():
-            key = token_map[key_id]
-            value_ids = getValueIds(key)
-            values = []
-            for value_id in value_ids:
-                if value_id in token_map.keys():
-                    value = token_map[value_id]
-                    values.append(getText(value, token_map))
-            value_text = ' '.join(values)
-            key_text = getText(token_map[key_id], token_map)
-            y = key['Geometry']['BoundingBox']['Top']
-            mappings[key_text] = {'Value': value_text, 'Top': y}
+        value_ids = getValueIds(key_id, index)
+        values = []
+        for value_id in value_ids:
+            if index.exists(value_id):
+                values.append(getText(value_id, index))
+        value_text = ' '.join(values)
+        key_text = getText(key_id, index)
+        y = index.top[key_id]
+        mappings[key_text] = {'Value': value_text, 'Top': y}
 
     return mappings
 
 """
-Load in a file in JSON format to a dictionary
+Load in a file in JSON format to a dictionary. If the file holds aliases and antialiases
+(e.g., meta.data), they are compiled into an AliasMatcher stored under 'matcher'
 
 Parameters
 ----------
@@ -357,6 +651,8 @@ data: (dictionary) any mapping output from a JSON file
 def loadData(file):
     with open(file) as fp:
         data = json.load(fp)
+    if 'key' in data and 'value' in data:
+        data['matcher'] = AliasMatcher(data)
     return data
 
 """
@@ -368,7 +664,8 @@ kv_json: (dictionary) unaltered output from Textract's get_document_analysis(...
                       and contains OCR extraction information on key-value pairs
                       
 raw_json: (dictionary) unaltered output from Textract's get_document_text_detection(...)
-                       API and contains OCR extraction information on text blocks
+                       API and contains OCR extraction information on text blocks. May also be
+                       a function returning it, which is only called if Phase 2 is needed
                        
 META: (dictionary) a mapping of different of key words (aliases) and words that indicate wrong 
                    selection (antialiases) to our desired metadata (first, last, and graduation 
@@ -382,36 +679,198 @@ form: (dictionary) a mapping of metadata names to extracted information. In othe
                    a transcript are the values (e.g. what the first name is)
 """
 def main(kv_json, raw_json, META):
-    form = {'First': 'NA',
-            'Last': 'NA',
-            'Grad': 'NA'}
+    form = dict.fromkeys(getFields(META), 'NA')
 
     # Extract metadata from key-value blocks
     key_value_dict = getKeyValues(kv_json['Blocks'], META)
     form.update(key_value_dict)
 
-    print(form)
+    log.debug(form)
+    metrics.count('documents')
 
-    # Identify what information is still missing
-    nas = []
-    for k, v in form.items():
-        if v == 'NA':
-            nas.append(k)  # Append the missing keys
+    # Identify what information is still missing and can be found in raw text
+    nas = getMissing(form, META)
 
-    if 'NA' in form.values():
-        print('Incomplete extraction...')
+    if len(nas) > 0:
+        log.debug('Incomplete extraction...')
+        metrics.count('phase2_documents')
 
         # Use the raw text blocks to find remaining metadata
-        rem_dict = getRemainder(raw_json['Blocks'], nas, META)
+        with metrics.span('phase2'):
+            if callable(raw_json):
+                raw_json = raw_json()
+            rem_dict = getRemainder(raw_json['Blocks'], nas, META)
         form.update(rem_dict)
     else:
-        print('Complete extraction...')
+        log.debug('Complete extraction...')
 
-    print(form)
+    log.debug(form)
     return form
 
 """
-Simulating event and context event triggers in AWS
+Extracts key metadata information from many transcripts at once. Rather than running NER
+document by document, Phase 1 queues the key-value values of every transcript and runs them
+through spacy as one large batch, then Phase 2 does the same with the top-of-page lines of
+the transcripts that are still missing a name. Meant for bulk runs where documents per second
+matters more than the latency of any single document
+
+Parameters
+----------
+documents: (dictionary) key is a transcript folder name, and is mapped to a (kv_json, raw_json)
+                        tuple as read with source.response(...). raw_json may be a function
+                        returning it, which is only called for incomplete transcripts
+
+META: (dictionary) a mapping of different of key words (aliases) and words that indicate wrong
+                   selection (antialiases) to our desired metadata (see main)
+
+batch_size: (int) the number of strings the transformer processes at a time
+
+n_process: (int) the number of processes spacy spreads each batch over
+
+Returns
+-------
+forms: (dictionary) key is a transcript folder name, and is mapped to its extracted form
+"""
+def batchMain(documents, META, batch_size=64, n_process=1):
+    forms = {}
+
+    # Phase 1. Queue up the key-value values of every document
+    scheduler = NERScheduler(getCache(), batch_size, n_process)
+    mappings = {}
+    detectors = {}
+    for k, (kv_json, raw_json) in documents.items():
+        mappings[k] = getKVMappings(kv_json['Blocks'])
+        detectors[k] = EntityDetector(META)
+        scheduler.submit(k, detectors[k].getValues(mappings[k][0]))
+    entities = scheduler.run()
+    metrics.count('documents', len(documents))
+
+    nas = {}
+    for k, (mapping, confidence) in mappings.items():
+        form = dict.fromkeys(getFields(META), 'NA')
+        form.update(detectors[k].detectEntityKV(mapping, entities.get(k, {})))
+        log.debug(f'{k}: NER on {detectors[k].ner_calls} values, {detectors[k].ner_saved} skipped')
+        form['Confidence'] = confidence
+        forms[k] = form
+
+        missing = getMissing(form, META)
+        if len(missing) > 0:
+            nas[k] = missing
+
+    # Phase 2. Queue up the region lines of every incomplete document
+    metrics.count('phase2_documents', len(nas))
+    with metrics.span('phase2'):
+        scheduler = NERScheduler(getCache(), batch_size, n_process)
+        lines = {}
+        for k in nas.keys():
+            raw_json = documents[k][1]
+            if callable(raw_json):
+                raw_json = raw_json()
+            lines[k] = getRegionLines(raw_json['Blocks'], nas[k], META)
+            if needsEntities(nas[k], META):
+                scheduler.submit(k, lines[k][0])  # Only names need NER (see RawEntDetector)
+        entities = scheduler.run()
+
+        for k, (text, confidence) in lines.items():
+            form = RawEntDetector(META).detectEntity(nas[k], text, entities.get(k, {}))
+            form['Confidence'] = confidence
+            forms[k].update(form)
+
+    return forms
+
+"""
+Converts the Textract output of every transcript in an S3 bucket into compact artifacts (see
+Artifact.py). Only needs to be run once; afterwards extractArtifacts(...) can re-run extraction
+over the corpus without touching the Textract JSON
+
+Parameters
+----------
+bucket: (string) the string name of the S3 bucket on an AWS account. May be None if a source
+                  is given
+
+directory: (string) local folder the artifacts are written to. Each transcript folder becomes
+                    <directory>/<folder>.txa
+
+source: (S3Source or LocalSource) where the Textract output is read from. Defaults to the
+                                    S3 bucket (see Storage.py)
+
+Returns
+-------
+failed: (list) the folder names of the transcripts that could not be converted. They are logged
+               and skipped, and no artifact is left for them
+"""
+def convertArtifacts(bucket, directory, source=None):
+    if source is None:
+        source = S3Source(bucket)
+    failed = []
+    for k in sorted(source.list()):
+        path = os.path.join(directory, f'{k}.txa')
+        try:
+            kv_json = source.response(k, 'kv.json')
+            raw_json = source.response(k, 'raw.json')
+            mappings, kv_confidence = getKVMappings(kv_json['Blocks'])
+            lines, raw_confidence = getLines(raw_json['Blocks'])
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            writeArtifact(path, mappings, kv_confidence, lines, raw_confidence)
+        except Exception as e:
+            log.error(f'Conversion failed for {k}: {e!r}')
+            failed.append(k)
+            if os.path.exists(path):
+                os.remove(path)  # A half-written artifact would be read by extractArtifacts
+            continue
+        log.info(path)
+    return failed
+
+"""
+Re-runs extraction over artifacts written by convertArtifacts(...). Meant for iterating on
+meta.data and the scoring rules
+
+Parameters
+----------
+directory: (string) local folder the artifacts were written to
+
+META: (dictionary) a mapping of different of key words (aliases) and words that indicate wrong
+                   selection (antialiases) to our desired metadata (see main)
+
+Returns
+-------
+output: (list) the extracted form of every transcript, with its folder name as the 'ARN'.
+               Transcripts that fail are logged and left out
+"""
+def extractArtifacts(directory, META):
+    output = []
+    for root, dirs, files in os.walk(directory):
+        for file in sorted(files):
+            if not file.endswith('.txa'):
+                continue
+            path = os.path.join(root, file)
+            try:
+                kv_json, raw_json = loadArtifact(path)
+            except Exception as e:
+                log.error(f'Extraction failed for {path}: {e!r}')
+                continue
+
+            try:
+                form = main(kv_json, raw_json, META)
+                form['ARN'] = os.path.relpath(path, directory)[:-len('.txa')]
+                output.append(form)
+            except Exception as e:
+                log.error(f'Extraction failed for {path}: {e!r}')
+            finally:
+                kv_json['Artifact'].close()  # One bad transcript must not keep its file mapped
+    return output
+
+"""
+Simulating event and context event triggers in AWS. Given a local directory of Textract output
+and an output file (python main.py <directory> <output.jsonl or output.db>), reprocesses the
+directory offline instead
 """
 if __name__ == '__main__':
-    response = lambda_handler(bucket='Bucket')
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'), format='%(message)s')
+    if len(sys.argv) == 3:
+        directory, output = sys.argv[1:]
+        sink = SQLiteSink(output) if output.endswith(('.db', '.sqlite')) else JSONLSink(output)
+        response = lambda_handler(None, source=LocalSource(directory), sink=sink)
+    else:
+        response = lambda_handler(bucket='Bucket')
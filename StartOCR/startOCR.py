@@ -1,44 +1,339 @@
 import boto3
+import hashlib
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Textract start-job quotas (transactions per second). Match them to the account's service quotas
+ANALYSIS_TPS = 2
+DETECTION_TPS = 2
+
+# Error codes AWS uses when a request is throttled rather than rejected
+THROTTLING = {'ThrottlingException', 'ProvisionedThroughputExceededException', 'LimitExceededException',
+              'RequestLimitExceeded', 'TooManyRequestsException', 'SlowDown'}
 
 """
 Retrieves PDF transcript files from S3 bucket and starts OCR jobs on them.
 Job ids are stored in DynamoDB on AWS. Textract OCR jobs include raw text
 and key-value pair extraction.
 
+Jobs are started from a pool of threads. A token bucket per Textract API keeps the combined
+request rate under the TPS quota, throttled calls are retried with exponential backoff, and
+job ids are written 25 at a time with batch_write_item. Transcripts already in the table
+with the same ETag are skipped, so running the handler again neither starts their jobs again
+nor resets the JobState that GetOCRResults keeps on their items. Clients can be passed in, so
+the whole engine runs against local stub clients (see test_startOCR.py).
+
+Parameters
+----------
+bucket: (string) the text representation of the name of the S3 bucket
+
+table: (string) the text representation of the name of the DynamoDB table
+
+workers: (int) the number of transcripts submitted at the same time
+
+db, s3, textract: (clients) boto3 clients (or stubs with the same methods). Created if not given
+
+Returns
+-------
+summary: (dictionary) 'Submitted' is the number of transcripts whose jobs were started and
+                      recorded, 'Skipped' the number already in the table, and 'Failed' lists
+                      the keys of transcripts that could not be.
+                      The job ids of failed transcripts that were started are printed, and
+                      running the handler again reuses them (see startJobs)
+"""
+def lambda_handler(bucket, table, workers=8, db=None, s3=None, textract=None):
+    db = db or boto3.client('dynamodb', region_name='us-east-2')  # Initialize AWS database client
+    s3 = s3 or boto3.client('s3', region_name='us-east-2')
+    textract = textract or boto3.client('textract', region_name='us-east-2')
+
+    limits = {'analysis': TokenBucket(ANALYSIS_TPS), 'detection': TokenBucket(DETECTION_TPS)}
+
+    recorded = recordedJobs(db, table)
+    files = {}
+    skipped = 0
+    for file, etag in listFiles(s3, bucket):
+        if file not in recorded or recorded[file] not in (None, etag):  # New or uploaded again
+            files[file] = etag
+        else:
+            skipped += 1
+
+    submitted = 0
+    failed = []
+    pending = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(startJobs, textract, bucket, file, etag, limits): file
+                   for file, etag in files.items()}
+        for future in as_completed(futures):
+            try:
+                pending.append(future.result())
+            except Exception as e:
+                print(f'Could not start jobs for {futures[future]}: {e}')
+                failed.append(futures[future])
+                continue
+
+            if len(pending) == 25:
+                submitted += recordJobs(db, table, pending, failed)
+                pending = []
+    if len(pending) > 0:
+        submitted += recordJobs(db, table, pending, failed)
+
+    return {'Submitted': submitted, 'Skipped': skipped, 'Failed': failed}
+
+"""
+Writes job ids with writeJobs(...) and adds the transcripts whose records could not be written
+to the failed list, printing their job ids so they are not lost
+
+Parameters
+----------
+db: (client) a boto3 DynamoDB client
+
+table: (string) the text representation of the name of the DynamoDB table
+
+items: (list) DynamoDB items as returned by startJobs(...)
+
+failed: (list) keys of the transcripts that failed so far. Updated in place
+
+Returns
+-------
+written: (int) the number of items written
+"""
+def recordJobs(db, table, items, failed):
+    unwritten = writeJobs(db, table, items)
+    for item in unwritten:
+        print(f'Could not record jobs for {item["ARN"]["S"]}: '
+              f'kv_job {item["kv_job"]["S"]}, raw_job {item["raw_job"]["S"]}')
+        failed.append(item['ARN']['S'])
+    return len(items) - len(unwritten)
+
+"""
+Lists every PDF in the bucket, page by page, so buckets with more than 1000 keys are covered
+
+Parameters
+----------
+s3: (client) a boto3 S3 client
+
+bucket: (string) the text representation of the name of the S3 bucket
+
+Returns
+-------
+files: (generator) the key and ETag of every object in the bucket
+"""
+def listFiles(s3, bucket):
+    kwargs = {'Bucket': bucket}
+    while True:
+        response = s3.list_objects_v2(**kwargs)
+        for object in response.get('Contents', []):
+            if not object['Key'].endswith('/'):
+                yield object['Key'], object['ETag']
+        if not response.get('IsTruncated'):
+            break
+        kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+"""
+Lists the transcripts whose job ids are already recorded. The table is scanned page by page
+for the ARN and ETag of each item
+
+Parameters
+----------
+db: (client) a boto3 DynamoDB client
+
+table: (string) the text representation of the name of the DynamoDB table
+
+Returns
+-------
+recorded: (dictionary) key is the key of a transcript PDF and is mapped to the ETag its jobs
+                       were started for, or None for items recorded before ETags were kept
+"""
+def recordedJobs(db, table):
+    recorded = {}
+    kwargs = {'TableName': table, 'ProjectionExpression': '#arn, ETag',
+              'ExpressionAttributeNames': {'#arn': 'ARN'}}
+    while True:
+        response = withBackoff(lambda: db.scan(**kwargs))
+        for item in response.get('Items', []):
+            recorded[item['ARN']['S']] = item['ETag']['S'] if 'ETag' in item else None
+        if 'LastEvaluatedKey' not in response:
+            return recorded
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+"""
+Starts the key-value pair and raw text OCR jobs of one transcript. Both requests carry a
+ClientRequestToken derived from the bucket, key and ETag, so Textract answers a repeated
+request (a throttled retry or the handler running again) with the job it already started
+instead of starting another one, while a PDF uploaded again under the same key gets new jobs
+
+Parameters
+----------
+textract: (client) a boto3 Textract client
+
+bucket: (string) the text representation of the name of the S3 bucket
+
+file: (string) the key of the transcript PDF
+
+etag: (string) the ETag of the transcript PDF
+
+limits: (dictionary) the TokenBucket of the 'analysis' and of the 'detection' API
+
+Returns
+-------
+db_items: (dictionary) the DynamoDB item recording the job ids of the transcript
+"""
+def startJobs(textract, bucket, file, etag, limits):
+    location = {'S3Object': {'Bucket': bucket, 'Name': file}}
+    token = jobToken(bucket, file, etag)
+
+    # key-value pair OCR extraction AWS job id
+    kv_job = withBackoff(lambda: textract.start_document_analysis(
+        DocumentLocation=location,
+        FeatureTypes=['FORMS'],
+        ClientRequestToken=token), limits['analysis'])['JobId']
+
+    # raw text OCR extraction AWS job id
+    try:
+        raw_job = withBackoff(lambda: textract.start_document_text_detection(
+            DocumentLocation=location,
+            ClientRequestToken=token), limits['detection'])['JobId']
+    except Exception as e:
+        raise RuntimeError(f'kv_job {kv_job} started but the raw text job failed: {e}') from e
+
+    db_items = {
+        'ARN': {'S': file},
+        'kv_job': {'S': kv_job},
+        'raw_job': {'S': raw_job},
+        'ETag': {'S': etag}
+    }
+    return db_items
+
+"""
+The idempotency token of a transcript's Textract jobs (at most 64 characters of [a-zA-Z0-9-_])
+
 Parameters
 ----------
 bucket: (string) the text representation of the name of the S3 bucket
 
+file: (string) the key of the transcript PDF
+
+etag: (string) the ETag of the transcript PDF, which changes when it is uploaded again
+
+Returns
+-------
+token: (string) the same token every time for the same upload of a transcript
+"""
+def jobToken(bucket, file, etag):
+    return hashlib.sha256(f'{bucket}/{file}/{etag}'.encode('utf-8')).hexdigest()
+
+"""
+Records job ids in DynamoDB, 25 items per batch_write_item call (the API's limit). Items
+DynamoDB leaves unprocessed are sent again with backoff. A batch that still fails is given
+back rather than raised, so the batches after it are written
+
+Parameters
+----------
+db: (client) a boto3 DynamoDB client
+
 table: (string) the text representation of the name of the DynamoDB table
+
+items: (list) DynamoDB items as returned by startJobs(...)
+
+Returns
+-------
+unwritten: (list) the items that could not be written
 """
-def lambda_handler(bucket, table):
-    db = boto3.client('dynamodb', region_name='us-east-2')  # Initialize AWS database client
-    s3 = boto3.client('s3', region_name='us-east-2')
-    textract = boto3.client('textract', region_name='us-east-2')
-
-    bucket = bucket
-
-    objects = s3.list_objects(Bucket=bucket)['Contents']
-    
-    for object in objects:
-        file = object['Key']
-        
-        # key-value pair OCR extraction AWS job id
-        kv_job = textract.start_document_analysis(
-            DocumentLocation={'S3Object': {'Bucket': bucket, 'Name': file}},
-            FeatureTypes=['FORMS'])['JobId']
-        
-        # raw text OCR extraction AWS job id
-        raw_job = textract.start_document_text_detection(
-            DocumentLocation={'S3Object': {'Bucket': bucket, 'Name': file}})['JobId']
-
-        db_items = {
-            'ARN': {'S': file},
-            'kv_job': {'S': kv_job},
-            'raw_job': {'S': raw_job}
-        }
-
-        db.put_item(
-            TableName=table,
-            Item=db_items
-        )
+def writeJobs(db, table, items):
+    unwritten = []
+    for i in range(0, len(items), 25):
+        requests = {table: [{'PutRequest': {'Item': item}} for item in items[i:i + 25]]}
+        attempt = 0
+        try:
+            while requests:
+                response = withBackoff(lambda: db.batch_write_item(RequestItems=requests))
+                requests = response.get('UnprocessedItems') or {}
+                if requests:
+                    attempt += 1
+                    if attempt > 8:
+                        raise RuntimeError(f'DynamoDB left {len(requests[table])} job records unprocessed')
+                    time.sleep(backoff(attempt))
+        except Exception as e:
+            print(f'Could not write job records: {e}')
+            unwritten += [request['PutRequest']['Item'] for request in requests[table]]
+    return unwritten
+
+"""
+Calls an AWS API, waiting for a rate limiter first and retrying with exponential backoff when
+AWS throttles the call. Other errors are raised right away
+
+Parameters
+----------
+call: (function) makes the request
+
+limiter: (TokenBucket) if given, a token is taken before every attempt
+
+retries: (int) the number of times a throttled call is retried
+
+Returns
+-------
+response: (dictionary) the response of the call
+"""
+def withBackoff(call, limiter=None, retries=8):
+    attempt = 0
+    while True:
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            return call()
+        except Exception as e:
+            code = getattr(e, 'response', {}).get('Error', {}).get('Code')
+            if code not in THROTTLING or attempt >= retries:
+                raise
+            attempt += 1
+            time.sleep(backoff(attempt))
+
+"""
+The time to wait before a retry, with full jitter so throttled threads do not retry in step
+
+Parameters
+----------
+attempt: (int) how many times the call has been retried, starting at 1
+
+Returns
+-------
+delay: (float) seconds to wait
+"""
+def backoff(attempt, base=0.5, cap=20.0):
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+"""
+Allows at most a fixed number of requests per second across every thread, with short bursts
+up to the bucket's capacity
+
+Parameters
+----------
+rate: (float) tokens added per second, i.e. the sustained requests per second
+
+capacity: (float) the most tokens the bucket holds. Defaults to one second worth of tokens
+"""
+class TokenBucket():
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    """
+    Takes a token, waiting until one is available
+    """
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
@@ -0,0 +1,135 @@
+import sys
+import types
+import unittest
+from unittest import mock
+
+sys.modules.setdefault('boto3', types.ModuleType('boto3'))  # The stubs below stand in for every client
+import startOCR
+
+"""
+An error shaped like the botocore ClientError AWS raises, with its code in 'response'
+"""
+class StubError(Exception):
+
+    def __init__(self, code):
+        super().__init__(code)
+        self.response = {'Error': {'Code': code}}
+
+"""
+A bucket listed two keys per page, so pagination is exercised
+"""
+class StubS3():
+
+    def __init__(self, objects):
+        self.objects = objects
+
+    def list_objects_v2(self, Bucket, ContinuationToken=0):
+        page = self.objects[ContinuationToken:ContinuationToken + 2]
+        response = {'Contents': [{'Key': key, 'ETag': etag} for key, etag in page]}
+        if ContinuationToken + 2 < len(self.objects):
+            response.update(IsTruncated=True, NextContinuationToken=ContinuationToken + 2)
+        return response
+
+"""
+Textract that throttles the first calls of each API and, like the real service, answers a
+repeated ClientRequestToken with the job it already started
+"""
+class StubTextract():
+
+    def __init__(self, throttled=2):
+        self.throttled = {'analysis': throttled, 'detection': throttled}
+        self.jobs = {}
+        self.started = 0
+
+    def start_document_analysis(self, DocumentLocation, FeatureTypes, ClientRequestToken):
+        return self.__start__('analysis', ClientRequestToken)
+
+    def start_document_text_detection(self, DocumentLocation, ClientRequestToken):
+        return self.__start__('detection', ClientRequestToken)
+
+    def __start__(self, api, token):
+        if self.throttled[api] > 0:
+            self.throttled[api] -= 1
+            raise StubError('ThrottlingException')
+        if (api, token) not in self.jobs:
+            self.started += 1
+            self.jobs[(api, token)] = f'{api}-{self.started}'
+        return {'JobId': self.jobs[(api, token)]}
+
+"""
+DynamoDB that leaves the last item of the first batch unprocessed
+"""
+class StubDynamo():
+
+    def __init__(self):
+        self.items = {}
+        self.unprocessed = 1
+
+    def scan(self, TableName, ProjectionExpression, ExpressionAttributeNames, ExclusiveStartKey=None):
+        return {'Items': [dict(item) for item in self.items.values()]}
+
+    def batch_write_item(self, RequestItems):
+        (table, requests), = RequestItems.items()
+        left = requests[len(requests) - self.unprocessed:] if self.unprocessed else []
+        self.unprocessed = 0
+        for request in requests[:len(requests) - len(left)]:
+            item = request['PutRequest']['Item']
+            self.items[item['ARN']['S']] = item
+        return {'UnprocessedItems': {table: left} if left else {}}
+
+class TestLambdaHandler(unittest.TestCase):
+
+    def setUp(self):
+        patches = [mock.patch.object(startOCR.time, 'sleep'),
+                   mock.patch.object(startOCR, 'ANALYSIS_TPS', 1000),
+                   mock.patch.object(startOCR, 'DETECTION_TPS', 1000)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.objects = [(f'school/t{i}.pdf', f'"etag{i}"') for i in range(5)]
+        self.s3 = StubS3(self.objects)
+        self.textract = StubTextract()
+        self.db = StubDynamo()
+
+    def run_handler(self):
+        return startOCR.lambda_handler('bucket', 'jobs', workers=3, db=self.db, s3=self.s3,
+                                       textract=self.textract)
+
+    def test_throttling_and_unprocessed_items(self):
+        summary = self.run_handler()
+        self.assertEqual(summary, {'Submitted': 5, 'Skipped': 0, 'Failed': []})
+        self.assertEqual(sorted(self.db.items), [key for key, etag in self.objects])
+        self.assertEqual(self.textract.started, 10)
+        self.assertEqual(self.db.items['school/t0.pdf']['ETag'], {'S': '"etag0"'})
+
+    def test_rerun_skips_recorded_transcripts(self):
+        self.run_handler()
+        self.db.items['school/t0.pdf']['JobState'] = {'S': 'STORED'}
+        self.objects[1] = ('school/t1.pdf', '"changed"')  # Uploaded again
+
+        summary = self.run_handler()
+        self.assertEqual(summary, {'Submitted': 1, 'Skipped': 4, 'Failed': []})
+        self.assertEqual(self.db.items['school/t0.pdf']['JobState'], {'S': 'STORED'})
+        self.assertEqual(self.db.items['school/t1.pdf']['ETag'], {'S': '"changed"'})
+        self.assertEqual(self.textract.started, 12)  # New jobs for the new upload only
+
+    def test_failed_write_keeps_going(self):
+        calls = []
+        write = self.db.batch_write_item
+
+        def failing(RequestItems):
+            calls.append(RequestItems)
+            if len(calls) == 1:
+                raise StubError('ValidationException')
+            return write(RequestItems)
+
+        self.objects[:] = [(f'school/t{i}.pdf', f'"etag{i}"') for i in range(30)]  # Two batches
+        self.db.batch_write_item = failing
+        with mock.patch('builtins.print'):
+            summary = self.run_handler()
+        self.assertEqual(summary['Submitted'], 5)
+        self.assertEqual(len(summary['Failed']), 25)
+        self.assertEqual(len(self.db.items), 5)
+
+if __name__ == '__main__':
+    unittest.main()